@@ -1,21 +1,30 @@
 from abc import ABC, abstractmethod
+import bisect
+from contextlib import contextmanager
+from collections import deque
 from enum import Enum
+import functools
+import glob
 from pathlib import Path
 from datetime import datetime
 import random
 import re
 import time
-from typing import Any, Dict, List, Optional, Callable, Set, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Callable, Set, Tuple, TypeVar, cast
 
 import os
 import logging
 import hashlib
 import json
+import shutil
+import sqlite3
+import tempfile
 
 from unidecode import unidecode
 from git import Repo, GitCommandError
 from git.remote import RemoteProgress
 from pydantic import BaseModel
+from pydantic.json import pydantic_encoder
 from rich import print
 from rich.tree import Tree
 import github
@@ -29,8 +38,14 @@ class InternalError(Exception):
     pass
 
 
+class StateBackend(str, Enum):
+    JSON = "json"
+    SQLITE = "sqlite"
+
+
 class GlobalConfig(BaseModel):
     configs_root: str = os.path.expanduser("~/.config/gg")
+    state_backend: StateBackend = StateBackend(os.environ.get("GG_STATE_BACKEND", "json"))
 
 
 class Progress(RemoteProgress):
@@ -41,12 +56,25 @@ class Progress(RemoteProgress):
         print(self._cur_line)
 
 
+HASHED_FIELD_TYPES = (str, int, float, datetime, type(None))
+
+
 class GitGudModel(BaseModel):
     def __hash__(self) -> int:
-        md5 = hashlib.md5()
-        encoded = self.json(sort_keys=True).encode()
-        md5.update(encoded)
-        return hash(md5.hexdigest())
+        # Only scalar fields are hashed: models that compare equal always share
+        # them, and nested models and lists would need a full traversal.
+        return hash(
+            frozenset(
+                (name, value)
+                for name, value in self.__dict__.items()
+                if isinstance(value, HASHED_FIELD_TYPES)
+            )
+        )
+
+    def __eq__(self, other: Any) -> bool:
+        if self is other:
+            return True
+        return super().__eq__(other)
 
 
 class GudPullRequest(GitGudModel):
@@ -123,9 +151,14 @@ class GudCommit(GitGudModel):
     pull_request: Optional[GudPullRequest]
 
     history_branch: Optional[str]
-    snapshots: List[Snapshot] = []
+    snapshot_count: int = 0
+    latest_snapshot: Optional[Snapshot]
 
     date: Optional[datetime]
+    # Number of commits reachable from a remote commit but not from the cloned
+    # root. Along the remote history it grows with every commit, so it orders
+    # remote commits without asking git.
+    generation: Optional[int] = None
 
     def get_oneliner(self) -> str:
         return get_oneliner(self.description)
@@ -134,16 +167,84 @@ class GudCommit(GitGudModel):
         return Snapshot(hash=self.hash, description=self.description)
 
 
+class LazyCommits(Dict[str, GudCommit]):
+    """Commit mapping that holds raw stored commits and only builds and
+    validates a GudCommit the first time it is accessed."""
+
+    def __init__(self, raw_commits: Dict[str, Dict[str, Any]]):
+        super().__init__(raw_commits)  # type: ignore
+        self._pristine: Dict[str, Dict[str, Any]] = {}
+
+    def __getitem__(self, commit_id: str) -> GudCommit:
+        value = super().__getitem__(commit_id)
+        if isinstance(value, GudCommit):
+            return value
+
+        commit = GudCommit(**value)
+        self._pristine[commit_id] = commit.dict()
+        super().__setitem__(commit_id, commit)
+        return commit
+
+    def get(  # type: ignore
+        self, commit_id: str, default: Optional[GudCommit] = None
+    ) -> Optional[GudCommit]:
+        if commit_id in self:
+            return self[commit_id]
+        return default
+
+    def values(self) -> List[GudCommit]:  # type: ignore
+        return [self[commit_id] for commit_id in self]
+
+    def items(self) -> List[Tuple[str, GudCommit]]:  # type: ignore
+        return [(commit_id, self[commit_id]) for commit_id in self]
+
+    def pop(self, commit_id: str, *args: Any) -> Any:
+        if commit_id not in self:
+            return super().pop(commit_id, *args)
+
+        commit = self[commit_id]
+        self._pristine.pop(commit_id, None)
+        super().pop(commit_id)
+        return commit
+
+    def loaded(self) -> Dict[str, GudCommit]:
+        """Returns the commits that have been built so far."""
+
+        return {k: v for k, v in super().items() if isinstance(v, GudCommit)}
+
+    def get_pristine(self, commit_id: str) -> Optional[Dict[str, Any]]:
+        """Returns the commit as it was stored, if it has been loaded."""
+
+        return self._pristine.get(commit_id)
+
+
 class MergeConflictState(GitGudModel):
     current: str
     incoming: str
     files: List[str]
+    # Conflict pre-image id of each conflicted file, see `get_conflict_preimage_id`.
+    preimages: Dict[str, str] = {}
 
 
 class OperationType(str, Enum):
     EVOLVE = "EVOLVE"
 
 
+class ConflictPolicy(str, Enum):
+    # Sync stacks in order and stop on the first conflict.
+    STOP = "stop"
+    # Sync the stacks predicted to conflict after all the others.
+    DEFER = "defer"
+    # Leave the stacks predicted to conflict untouched.
+    SKIP = "skip"
+
+
+class TraversalOrder(str, Enum):
+    PRE_ORDER = "pre"
+    POST_ORDER = "post"
+    BFS = "bfs"
+
+
 class EvolveOperation(GitGudModel):
     base_commit_id: str
     target_commit_id: str
@@ -154,6 +255,23 @@ class PendingOperation(GitGudModel):
     evolve_op: EvolveOperation
 
 
+class PredictedConflict(GitGudModel):
+    commit_id: str
+    files: List[str]
+
+
+class SyncStack(GitGudModel):
+    # Oldest non remote commit of the stack, the one that gets rebased.
+    root_id: str
+    commit_ids: List[str] = []
+    # Commits expected to conflict when the stack is rebased, if predicted.
+    conflicts: List[PredictedConflict] = []
+
+
+class SyncPlan(GitGudModel):
+    stacks: List[SyncStack] = []
+
+
 class GitHubRepoMetadata(GitGudModel):
     owner: str
     name: str
@@ -196,6 +314,10 @@ class GitGudConfig(GitGudModel):
     randomize_branches: bool = True
     verbose: bool = False
     check_commits_on_status: bool = False
+    # Passed as --jobs to `git submodule update`, git's default when not set.
+    submodule_jobs: Optional[int] = None
+    # Record conflict resolutions and reuse them when the same conflict shows up again.
+    reuse_resolutions: bool = True
 
 
 class RepoState(GitGudModel):
@@ -341,6 +463,946 @@ def run_git_command_with_retries(cmd: Callable, *args: Any, **kwargs: Any) -> An
         raise last_error
 
 
+class CommitObject(GitGudModel):
+    hash: str
+    tree: str
+    parents: List[str] = []
+    # Raw author header: `Name <email> timestamp timezone`
+    author: str
+    author_date: datetime
+    message: str
+
+    def get_author_environ(self) -> Dict[str, str]:
+        """Environment for git commands that must keep this commit's author."""
+        name, _, rest = self.author.partition(" <")
+        email, _, date = rest.partition("> ")
+        return {"GIT_AUTHOR_NAME": name, "GIT_AUTHOR_EMAIL": email, "GIT_AUTHOR_DATE": date}
+
+
+class ObjectReader:
+    """Reads commit objects through the `git cat-file --batch` process that
+    GitPython keeps open for the repo, instead of starting a new git process
+    for every lookup.
+
+    Objects are immutable, so everything read by hash is cached."""
+
+    def __init__(self, repo: Repo):
+        self.repo = repo
+        self._commits: Dict[str, CommitObject] = {}
+
+    def read_commit(self, rev: str) -> CommitObject:
+        if rev in self._commits:
+            return self._commits[rev]
+
+        hexsha, typename, _, data = self.repo.git.get_object_data(rev)
+        if typename != b"commit":
+            raise ValueError(f"{rev} is not a commit")
+
+        commit = self._parse_commit(hexsha.decode(), data.decode("utf-8", errors="replace"))
+        self._commits[commit.hash] = commit
+        return commit
+
+    def tree(self, rev: str) -> str:
+        return self.read_commit(rev).tree
+
+    def parents(self, rev: str) -> List[str]:
+        return self.read_commit(rev).parents
+
+    @staticmethod
+    def _parse_commit(hexsha: str, data: str) -> CommitObject:
+        headers, _, message = data.partition("\n\n")
+        tree = ""
+        parents: List[str] = []
+        author = ""
+        author_date = None
+        for line in headers.split("\n"):
+            key, _, value = line.partition(" ")
+            if key == "tree":
+                tree = value
+            elif key == "parent":
+                parents.append(value)
+            elif key == "author":
+                # Name <email> timestamp timezone
+                author = value
+                timestamp = int(value.rsplit(" ", 2)[1])
+                author_date = datetime.fromtimestamp(timestamp).astimezone()
+
+        assert author_date is not None
+        return CommitObject(
+            hash=hexsha,
+            tree=tree,
+            parents=parents,
+            author=author,
+            author_date=author_date,
+            message=message,
+        )
+
+
+def get_changed_submodules(repo: Repo, old_rev: str, new_rev: str) -> List[str]:
+    """Returns the paths of the submodules whose gitlink was added or moved
+    between the two given commits."""
+
+    output = repo.git.diff_tree("-r", "-z", "--no-renames", old_rev, new_rev)
+    fields = output.split("\0")
+    paths = []
+    # Each change is a `:old_mode new_mode old_hash new_hash status` field
+    # followed by a path field.
+    for info, path in zip(fields[0::2], fields[1::2]):
+        new_mode = info.split(" ")[1] if " " in info else ""
+        if new_mode == "160000":
+            paths.append(path)
+    return paths
+
+
+def update_submodules(
+    repo: Repo, old_rev: Optional[str], new_rev: str, jobs: Optional[int] = None
+) -> None:
+    """Update the submodules whose gitlink changed between the two commits.
+    When the previous commit is not known, all submodules are updated."""
+
+    args = ["update", "--init", "--recursive"]
+    if jobs:
+        args += ["--jobs", str(jobs)]
+
+    if old_rev is not None:
+        if old_rev == new_rev:
+            return
+        paths = get_changed_submodules(repo, old_rev, new_rev)
+        if not paths:
+            return
+        args += ["--", *paths]
+
+    run_git_command_with_retries(repo.git.submodule, *args)
+
+
+CONFLICT_MARKERS = (b"<<<<<<<", b"|||||||", b"=======", b">>>>>>>")
+
+
+def get_conflict_preimage_id(content: bytes) -> Optional[str]:
+    """Returns an id for a file with conflict markers, or None if there are no
+    conflicts in it.
+
+    The labels after the markers name the commits being rebased, so they are
+    stripped and the same conflict gets the same id on every evolve."""
+
+    lines = []
+    conflicted = False
+    for line in content.splitlines(keepends=True):
+        for marker in CONFLICT_MARKERS:
+            if line.startswith(marker):
+                conflicted = conflicted or marker == b"<<<<<<<"
+                line = marker + b"\n"
+                break
+        lines.append(line)
+
+    if not conflicted:
+        return None
+    return hashlib.sha1(b"".join(lines)).hexdigest()
+
+
+class StatusEntry(GitGudModel):
+    # One of the `git status --porcelain=v2` entry types: 1, 2, u or ?
+    kind: str
+    # Index and worktree status, `..` for untracked files.
+    xy: str
+    path: str
+
+
+def iter_status(repo: Repo) -> Iterator[StatusEntry]:
+    """Stream the entries of `git status --porcelain=v2 -z` as git produces
+    them. Callers can stop at any point, the git process is then killed.
+
+    Being plain `git status`, it uses the untracked cache and fsmonitor when
+    they are enabled in the repo."""
+
+    process = repo.git.status(
+        "--porcelain=v2", "-z", "--untracked-files=all", "--ignore-submodules=none", as_process=True
+    )
+    stdout = process.proc.stdout
+    buffer = b""
+    skip_next = False
+    try:
+        while True:
+            chunk = stdout.read(65536)
+            if not chunk:
+                break
+            buffer += chunk
+            *records, buffer = buffer.split(b"\0")
+            for record in records:
+                if skip_next:
+                    # Original path of a rename or copy.
+                    skip_next = False
+                    continue
+
+                line = record.decode("utf-8", errors="surrogateescape")
+                kind = line[0:1]
+                if kind == "1":
+                    fields = line.split(" ", 8)
+                elif kind == "2":
+                    fields = line.split(" ", 9)
+                    skip_next = True
+                elif kind == "u":
+                    fields = line.split(" ", 10)
+                elif kind == "?":
+                    yield StatusEntry(kind=kind, xy="..", path=line[2:])
+                    continue
+                else:
+                    continue
+                yield StatusEntry(kind=kind, xy=fields[1], path=fields[-1])
+
+        # Only a stream read to the end tells whether git succeeded, a failing
+        # git must not look like a clean tree.
+        status = process.proc.wait()
+        if status != 0:
+            stderr = process.proc.stderr.read() if process.proc.stderr else b""
+            raise GitCommandError(["git", "status"], status, stderr)
+    finally:
+        if process.proc.poll() is None:
+            process.proc.kill()
+        process.proc.wait()
+
+
+class Ref(GitGudModel):
+    name: str
+    hash: str
+    # Tree of the commit the ref points to, not set for refs to other objects.
+    tree: Optional[str]
+
+
+class RepoView:
+    """Repository data that is expensive to compute: the dirty state, refs and
+    HEAD. Each one is computed the first time it's needed and shared by all
+    callers until `invalidate()` is called, which GitGud does whenever it
+    changes the repo."""
+
+    def __init__(self, repo: Repo):
+        self.repo = repo
+        self._dirty_state: Optional[DirtyState] = None
+        self._is_dirty: Optional[bool] = None
+        self._refs: Optional[Dict[str, Ref]] = None
+        self._head: Optional[str] = None
+
+    def invalidate(self) -> None:
+        self._dirty_state = None
+        self._is_dirty = None
+        self._refs = None
+        self._head = None
+
+    def get_dirty_state(self) -> DirtyState:
+        if self._dirty_state is None:
+            state = DirtyState()
+            for entry in iter_status(self.repo):
+                if entry.kind == "?":
+                    state.untracked_files.append(entry.path)
+                elif entry.xy[1] != ".":
+                    # Only changes in the working tree that are not in the index.
+                    state.modified_files.append(entry.path)
+
+            self._dirty_state = state
+        return self._dirty_state
+
+    def is_dirty(self) -> bool:
+        """Same as checking the dirty state, but stops at the first change found."""
+
+        if self._dirty_state is not None:
+            return self._dirty_state != DirtyState()
+
+        if self._is_dirty is None:
+            self._is_dirty = any(
+                entry.kind == "?" or entry.xy[1] != "." for entry in iter_status(self.repo)
+            )
+        return self._is_dirty
+
+    def get_refs(self) -> Dict[str, Ref]:
+        """Returns all refs by short name."""
+
+        if self._refs is None:
+            output = self.repo.git.for_each_ref(
+                "--format=%(refname:short) %(objectname) %(tree)"
+            )
+            refs = {}
+            for line in output.splitlines():
+                name, hash, tree = line.split(" ")
+                refs[name] = Ref(name=name, hash=hash, tree=tree or None)
+            self._refs = refs
+        return self._refs
+
+    def get_head(self) -> str:
+        """Returns the hash of the commit checked out."""
+
+        if self._head is None:
+            self._head = self.repo.head.commit.hexsha
+        return self._head
+
+
+class RefChange(GitGudModel):
+    # None if the branch is deleted.
+    new_hash: Optional[str]
+    # Value expected before the transaction, not checked when None.
+    old_hash: Optional[str]
+    existed: bool = True
+
+
+class RefTransaction:
+    """Branch creations, moves and deletions queued during a GitGud operation.
+
+    They are applied atomically, all of them or none, with a single
+    `git update-ref --stdin` call. Several changes to the same branch are
+    combined into one. Until then, queued values are visible through
+    `resolve()`."""
+
+    def __init__(self, repo: Repo):
+        self.repo = repo
+        self.pending: Dict[str, RefChange] = {}
+
+    def create(self, branch: str, new_hash: str) -> None:
+        self._queue(branch, new_hash, RefChange(new_hash=new_hash, old_hash=None, existed=False))
+
+    def update(self, branch: str, new_hash: str, old_hash: str) -> None:
+        self._queue(branch, new_hash, RefChange(new_hash=new_hash, old_hash=old_hash))
+
+    def delete(self, branch: str) -> None:
+        self._queue(branch, None, RefChange(new_hash=None, old_hash=None))
+
+    def _queue(self, branch: str, new_hash: Optional[str], change: RefChange) -> None:
+        if branch in self.pending:
+            change = self.pending[branch]
+            change.new_hash = new_hash
+        self.pending[branch] = change
+
+    def resolve(self, branch: str) -> str:
+        """Returns the queued hash for a branch, or the branch name itself if it
+        has no queued changes, to be resolved by git."""
+
+        if branch not in self.pending:
+            return branch
+
+        new_hash = self.pending[branch].new_hash
+        if new_hash is None:
+            raise ValueError(f"Branch {branch} was deleted")
+        return new_hash
+
+    def apply(self) -> bool:
+        """Apply all queued changes. Returns False if there was nothing to do."""
+
+        commands = []
+        for branch, change in self.pending.items():
+            ref = f"refs/heads/{branch}"
+            old_hash = f" {change.old_hash}" if change.old_hash else ""
+            if not change.existed:
+                if change.new_hash is not None:
+                    commands.append(f"create {ref} {change.new_hash}\n")
+            elif change.new_hash is None:
+                commands.append(f"delete {ref}{old_hash}\n")
+            else:
+                commands.append(f"update {ref} {change.new_hash}{old_hash}\n")
+        self.pending = {}
+
+        if not commands:
+            return False
+
+        with tempfile.TemporaryFile() as stdin:
+            stdin.write("".join(commands).encode())
+            stdin.seek(0)
+            self.repo.git.update_ref("--stdin", istream=stdin)
+        return True
+
+
+class AncestryOracle:
+    """Answers ancestry questions from the object database, without touching
+    the working tree.
+
+    The answer for a given pair of hashes never changes, so every answer is
+    cached for the lifetime of the oracle."""
+
+    def __init__(self, repo: Repo):
+        self.repo = repo
+        self._cache: Dict[Tuple[str, str], bool] = {}
+
+    def is_ancestor(self, ancestor: str, descendant: str) -> bool:
+        """Returns True if `ancestor` is reachable from `descendant`. A commit
+        is its own ancestor."""
+
+        if ancestor == descendant:
+            return True
+
+        key = (ancestor, descendant)
+        if key not in self._cache:
+            try:
+                self.repo.git.merge_base("--is-ancestor", ancestor, descendant)
+                self._cache[key] = True
+            except GitCommandError as error:
+                if error.status != 1:
+                    raise
+                self._cache[key] = False
+        return self._cache[key]
+
+    def newest(self, hashes: List[str]) -> Optional[str]:
+        """Returns the hash that has all the other ones as ancestors, using a
+        single git process. Returns None if the history has diverged."""
+
+        unique = list(dict.fromkeys(hashes))
+        if len(unique) <= 1:
+            return unique[0] if unique else None
+
+        independent = self.repo.git.merge_base("--independent", *unique).split()
+        if len(independent) != 1:
+            return None
+
+        newest = independent[0]
+        for ancestor in unique:
+            self._cache[(ancestor, newest)] = True
+        return newest
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def transactional(method: F) -> F:
+    """Run a GitGud method inside a state transaction."""
+
+    @functools.wraps(method)
+    def wrapper(self: "GitGud", *args: Any, **kwargs: Any) -> Any:
+        with self.transaction():
+            return method(self, *args, **kwargs)
+
+    return cast(F, wrapper)
+
+
+def encode_json(value: Any) -> str:
+    return json.dumps(value, default=pydantic_encoder)
+
+
+def read_records(filename: str) -> Iterator[Dict[str, Any]]:
+    """Yields the records of an append-only file with one JSON record per line,
+    stopping at a torn record left at the end by an interrupted write."""
+
+    with open(filename, "rb") as f:
+        for line in f:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("Missing end of line")
+                record = json.loads(line)
+            except ValueError:
+                logging.info("Ignoring torn record in %s", filename)
+                return
+            yield record
+
+
+def append_records(filename: str, records: List[Dict[str, Any]]) -> None:
+    """Appends records to a file with one JSON record per line.
+
+    A torn record at the end is cut off first, otherwise the first new record
+    would be appended to it and be unreadable too."""
+
+    with open(filename, "a+b") as f:
+        end = f.seek(0, os.SEEK_END)
+        offset = end
+        while offset > 0:
+            start = max(0, offset - 4096)
+            f.seek(start)
+            chunk = f.read(offset - start)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                offset = start + newline + 1
+                break
+            offset = start
+
+        if offset != end:
+            logging.info("Truncating torn record in %s", filename)
+            f.truncate(offset)
+
+        f.write(b"".join(encode_json(record).encode("utf-8") + b"\n" for record in records))
+
+
+def extract_snapshots(obj: Dict[str, Any]) -> List[Tuple[str, int, Dict[str, Any]]]:
+    """Removes the inline snapshot lists that older states kept in each commit,
+    returning them as (commit_id, position, snapshot) archive records."""
+
+    records = []
+    for commit in obj["commits"].values():
+        if "snapshots" not in commit:
+            continue
+
+        snapshots = commit.pop("snapshots")
+        for position, snapshot in enumerate(snapshots):
+            records.append((commit["id"], position, snapshot))
+        commit["snapshot_count"] = len(snapshots)
+        commit["latest_snapshot"] = snapshots[-1] if snapshots else None
+
+    return records
+
+
+class StateStore(ABC):
+    """Persistence backend for a RepoState.
+
+    Stores remember the last state they persisted, so saving only writes the
+    top level fields and commits that changed since then.
+
+    Commit snapshots are kept out of the state, in an append-only archive of
+    (commit_id, position, snapshot) records where the latest record for a
+    position wins. Commits only keep a count, and the archive is read on demand.
+    """
+
+    def __init__(self) -> None:
+        self._fields: Optional[Dict[str, Any]] = None
+        self._commits: Dict[str, Dict[str, Any]] = {}
+        self._commit_ids: Set[str] = set()
+        self._pending_snapshots: List[Tuple[str, int, Dict[str, Any]]] = []
+
+    @abstractmethod
+    def exists(self) -> bool:
+        """Whether there is a stored state to load."""
+
+    @abstractmethod
+    def read(self) -> Dict[str, Any]:
+        """Returns the raw stored state."""
+
+    @abstractmethod
+    def read_snapshots(self, commit_id: str) -> Dict[int, Dict[str, Any]]:
+        """Returns the archived snapshots of a commit by position."""
+
+    @abstractmethod
+    def write_snapshots(self, records: List[Tuple[str, int, Dict[str, Any]]]) -> None:
+        """Append the given records to the snapshot archive."""
+
+    @abstractmethod
+    def write_changes(
+        self, fields: Dict[str, Any], commits: Dict[str, Dict[str, Any]], removed: List[str]
+    ) -> None:
+        """Store the given top level fields and commits, and delete the removed commits."""
+
+    @abstractmethod
+    def write_all(self, state: RepoState) -> None:
+        """Replace the stored state with the given one."""
+
+    def needs_checkpoint(self) -> bool:
+        return False
+
+    def load(self) -> Dict[str, Any]:
+        obj = self.read()
+        self._pending_snapshots.extend(extract_snapshots(obj))
+        return obj
+
+    def append_snapshot(self, commit_id: str, position: int, snapshot: Snapshot) -> None:
+        """Archive a snapshot, it is written together with the next save."""
+
+        self._pending_snapshots.append((commit_id, position, snapshot.dict()))
+
+    def get_snapshots(self, commit_id: str, count: int) -> List[Snapshot]:
+        by_position = self.read_snapshots(commit_id)
+        for pending_commit_id, position, snapshot in self._pending_snapshots:
+            if pending_commit_id == commit_id:
+                by_position[position] = snapshot
+
+        return [Snapshot(**by_position[i]) for i in range(count) if i in by_position]
+
+    def _flush_snapshots(self) -> None:
+        if self._pending_snapshots:
+            self.write_snapshots(self._pending_snapshots)
+            self._pending_snapshots = []
+
+    def mark_persisted(self, state: RepoState) -> None:
+        """Record the given state as the one currently stored."""
+
+        self._fields = state.dict(exclude={"commits"})
+        self._commits = {
+            commit_id: c.dict() for commit_id, c in StateStore._loaded(state.commits).items()
+        }
+        self._commit_ids = set(state.commits.keys())
+
+    @staticmethod
+    def _loaded(commits: Dict[str, GudCommit]) -> Dict[str, GudCommit]:
+        # Commits that were never loaded can't have changed.
+        if isinstance(commits, LazyCommits):
+            return commits.loaded()
+        return commits
+
+    def _get_persisted_commit(
+        self, commits: Dict[str, GudCommit], commit_id: str
+    ) -> Optional[Dict[str, Any]]:
+        if commit_id in self._commits:
+            return self._commits[commit_id]
+        if isinstance(commits, LazyCommits):
+            return commits.get_pristine(commit_id)
+        return None
+
+    def checkpoint(self, state: RepoState) -> None:
+        self._flush_snapshots()
+        self.write_all(state)
+        self.mark_persisted(state)
+
+    def save(self, state: RepoState) -> None:
+        # Snapshots go first, so the state never references missing snapshots.
+        self._flush_snapshots()
+        if self._fields is None or self.needs_checkpoint():
+            self.checkpoint(state)
+            return
+
+        fields = state.dict(exclude={"commits"})
+        commits = {
+            commit_id: c.dict() for commit_id, c in StateStore._loaded(state.commits).items()
+        }
+
+        changed_fields = {k: v for k, v in fields.items() if self._fields.get(k) != v}
+        changed_commits = {
+            k: v
+            for k, v in commits.items()
+            if self._get_persisted_commit(state.commits, k) != v
+        }
+        removed = sorted(self._commit_ids.difference(state.commits.keys()))
+        self._fields = fields
+        self._commits.update(commits)
+        self._commit_ids = set(state.commits.keys())
+        for commit_id in removed:
+            self._commits.pop(commit_id, None)
+
+        if changed_fields or changed_commits or removed:
+            self.write_changes(changed_fields, changed_commits, removed)
+
+
+class StateJournal(StateStore):
+    """Persists a RepoState as a full checkpoint plus an append-only journal.
+
+    Each save appends a single record with the changes to the journal. Loading
+    replays the journal on top of the checkpoint, and the journal is folded
+    back into the checkpoint once it grows past `max_entries` records.
+
+    Every checkpoint gets a new epoch, and only the journal of the epoch stored
+    in the checkpoint is replayed. A journal left behind by an interrupted
+    checkpoint is never applied on top of the newer state."""
+
+    def __init__(self, filename: str, max_entries: int = 100):
+        super().__init__()
+        self.filename = filename
+        # Checkpoints written before epochs existed use the plain journal name.
+        self.journal_filename = f"{filename}.journal"
+        self.snapshots_filename = f"{filename}.snapshots"
+        self.max_entries = max_entries
+        self._entries = 0
+        # Archived snapshots by commit id and position, read once on demand.
+        self._snapshots: Optional[Dict[str, Dict[int, Dict[str, Any]]]] = None
+        self._snapshot_records = 0
+
+    def exists(self) -> bool:
+        return os.path.exists(self.filename)
+
+    def _get_journal_filename(self, epoch: Optional[str]) -> str:
+        if epoch is None:
+            return f"{self.filename}.journal"
+        return f"{self.filename}.journal.{epoch}"
+
+    def read(self) -> Dict[str, Any]:
+        with open(self.filename, encoding="utf-8") as f:
+            obj = json.loads(f.read())
+
+        self.journal_filename = self._get_journal_filename(obj.pop("journal_epoch", None))
+        self._entries = 0
+        if not os.path.exists(self.journal_filename):
+            return obj
+
+        for record in read_records(self.journal_filename):
+            obj.update(record["fields"])
+            obj["commits"].update(record["commits"])
+            for commit_id in record["removed"]:
+                obj["commits"].pop(commit_id, None)
+            self._entries += 1
+
+        return obj
+
+    def needs_checkpoint(self) -> bool:
+        return self._entries >= self.max_entries
+
+    def _get_snapshot_index(self) -> Dict[str, Dict[int, Dict[str, Any]]]:
+        if self._snapshots is None:
+            self._snapshots = {}
+            self._snapshot_records = 0
+            if os.path.exists(self.snapshots_filename):
+                for record in read_records(self.snapshots_filename):
+                    by_position = self._snapshots.setdefault(record["commit_id"], {})
+                    by_position[record["position"]] = record["snapshot"]
+                    self._snapshot_records += 1
+        return self._snapshots
+
+    def read_snapshots(self, commit_id: str) -> Dict[int, Dict[str, Any]]:
+        return dict(self._get_snapshot_index().get(commit_id, {}))
+
+    def write_snapshots(self, records: List[Tuple[str, int, Dict[str, Any]]]) -> None:
+        append_records(
+            self.snapshots_filename,
+            [
+                {"commit_id": commit_id, "position": position, "snapshot": snapshot}
+                for commit_id, position, snapshot in records
+            ],
+        )
+        if self._snapshots is not None:
+            for commit_id, position, snapshot in records:
+                self._snapshots.setdefault(commit_id, {})[position] = snapshot
+            self._snapshot_records += len(records)
+
+    def _compact_snapshots(self, commit_ids: Set[str]) -> None:
+        """Rewrite the archive without the records of removed commits and the
+        records replaced by a later one."""
+
+        index = {
+            commit_id: by_position
+            for commit_id, by_position in self._get_snapshot_index().items()
+            if commit_id in commit_ids
+        }
+        records = [
+            {"commit_id": commit_id, "position": position, "snapshot": snapshot}
+            for commit_id, by_position in index.items()
+            for position, snapshot in sorted(by_position.items())
+        ]
+        if len(records) == self._snapshot_records:
+            return
+
+        temp_filename = f"{self.snapshots_filename}.tmp"
+        with open(temp_filename, "w", encoding="utf-8") as out_file:
+            for record in records:
+                out_file.write(encode_json(record) + "\n")
+        os.replace(temp_filename, self.snapshots_filename)
+        self._snapshots = index
+        self._snapshot_records = len(records)
+
+    def write_changes(
+        self, fields: Dict[str, Any], commits: Dict[str, Dict[str, Any]], removed: List[str]
+    ) -> None:
+        record = {"fields": fields, "commits": commits, "removed": removed}
+        append_records(self.journal_filename, [record])
+        self._entries += 1
+
+    def write_all(self, state: RepoState) -> None:
+        epoch = os.urandom(8).hex()
+        temp_filename = f"{self.filename}.tmp"
+        with open(temp_filename, "w", encoding="utf-8") as out_file:
+            out_file.write(
+                json.dumps(
+                    {**state.dict(), "journal_epoch": epoch}, indent=4, default=pydantic_encoder
+                )
+            )
+        os.replace(temp_filename, self.filename)
+
+        # Journals of previous epochs are ignored from now on.
+        self.journal_filename = self._get_journal_filename(epoch)
+        for filename in glob.glob(f"{glob.escape(self.filename)}.journal*"):
+            os.remove(filename)
+        self._entries = 0
+        self._compact_snapshots(set(state.commits.keys()))
+
+
+class SqliteStateStore(StateStore):
+    """Persists a RepoState in a SQLite database.
+
+    Commits, snapshots, pull requests and pending operations live in their own
+    tables, so saves only touch the rows that changed. A JSON state found next
+    to the database is migrated on first load."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS fields (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS commits (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS snapshots (
+            commit_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            description TEXT NOT NULL,
+            PRIMARY KEY (commit_id, position)
+        );
+        CREATE TABLE IF NOT EXISTS pull_requests (
+            commit_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS pending_operations (
+            position INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, filename: str):
+        super().__init__()
+        self.filename = filename
+        self.db_filename = f"{filename}.sqlite"
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if not self._connection:
+            self._connection = self._connect(self.db_filename)
+        return self._connection
+
+    def _connect(self, filename: str) -> sqlite3.Connection:
+        connection = sqlite3.connect(filename)
+        connection.executescript(self.SCHEMA)
+        return connection
+
+    def exists(self) -> bool:
+        return os.path.exists(self.db_filename) or StateJournal(self.filename).exists()
+
+    def read(self) -> Dict[str, Any]:
+        if not os.path.exists(self.db_filename):
+            return self._migrate_from_json()
+
+        obj: Dict[str, Any] = {}
+        for name, value in self.connection.execute("SELECT name, value FROM fields"):
+            obj[name] = json.loads(value)
+
+        pull_requests: Dict[str, Dict[str, Any]] = {}
+        for commit_id, data in self.connection.execute(
+            "SELECT commit_id, data FROM pull_requests"
+        ):
+            pull_requests[commit_id] = json.loads(data)
+
+        obj["commits"] = {}
+        for commit_id, data in self.connection.execute("SELECT id, data FROM commits"):
+            commit = json.loads(data)
+            commit["pull_request"] = pull_requests.get(commit_id)
+            obj["commits"][commit_id] = commit
+
+        obj["pending_operations"] = [
+            json.loads(data)
+            for (data,) in self.connection.execute(
+                "SELECT data FROM pending_operations ORDER BY position"
+            )
+        ]
+        return obj
+
+    def _migrate_from_json(self) -> Dict[str, Any]:
+        """Copy the JSON state and its snapshot archive into a new database.
+
+        The database is built under a temporary name and only renamed once it
+        is complete, an interrupted migration starts over on the next load."""
+
+        logging.info("Migrating %s to %s", self.filename, self.db_filename)
+        journal = StateJournal(self.filename)
+        obj = journal.read()
+        archived = [
+            (commit_id, position, snapshot)
+            for commit_id in obj["commits"]
+            for position, snapshot in journal.read_snapshots(commit_id).items()
+        ]
+
+        temp_filename = f"{self.db_filename}.tmp"
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+        self._connection = self._connect(temp_filename)
+        try:
+            self.write_snapshots(archived + extract_snapshots(obj))
+            with self.connection:
+                self._write_fields({k: v for k, v in obj.items() if k != "commits"})
+                for commit in obj["commits"].values():
+                    self._write_commit(commit)
+        finally:
+            self._connection.close()
+            self._connection = None
+
+        os.replace(temp_filename, self.db_filename)
+        return obj
+
+    def write_changes(
+        self, fields: Dict[str, Any], commits: Dict[str, Dict[str, Any]], removed: List[str]
+    ) -> None:
+        with self.connection:
+            self._write_fields(fields)
+            for commit in commits.values():
+                self._write_commit(commit)
+            for commit_id in removed:
+                self._delete_commit(commit_id)
+
+    def write_all(self, state: RepoState) -> None:
+        with self.connection:
+            for table in ["fields", "commits", "pull_requests", "pending_operations"]:
+                self.connection.execute(f"DELETE FROM {table}")
+            self._write_fields(state.dict(exclude={"commits"}))
+            for commit in state.commits.values():
+                self._write_commit(commit.dict())
+            self.connection.execute(
+                "DELETE FROM snapshots WHERE commit_id NOT IN (SELECT id FROM commits)"
+            )
+
+    def _write_fields(self, fields: Dict[str, Any]) -> None:
+        for name, value in fields.items():
+            if name == "pending_operations":
+                self.connection.execute("DELETE FROM pending_operations")
+                self.connection.executemany(
+                    "INSERT INTO pending_operations (position, data) VALUES (?, ?)",
+                    [(i, encode_json(op)) for i, op in enumerate(value)],
+                )
+                continue
+
+            self.connection.execute(
+                "INSERT OR REPLACE INTO fields (name, value) VALUES (?, ?)",
+                (name, encode_json(value)),
+            )
+
+    def _write_commit(self, commit: Dict[str, Any]) -> None:
+        self._delete_commit(commit["id"])
+        data = {k: v for k, v in commit.items() if k != "pull_request"}
+        self.connection.execute(
+            "INSERT INTO commits (id, data) VALUES (?, ?)", (commit["id"], encode_json(data))
+        )
+        pull_request = commit.get("pull_request")
+        if pull_request:
+            self.connection.execute(
+                "INSERT INTO pull_requests (commit_id, data) VALUES (?, ?)",
+                (commit["id"], encode_json(pull_request)),
+            )
+
+    def _delete_commit(self, commit_id: str) -> None:
+        self.connection.execute("DELETE FROM commits WHERE id = ?", (commit_id,))
+        self.connection.execute("DELETE FROM pull_requests WHERE commit_id = ?", (commit_id,))
+
+    def read_snapshots(self, commit_id: str) -> Dict[int, Dict[str, Any]]:
+        query = "SELECT position, hash, description FROM snapshots WHERE commit_id = ?"
+        return {
+            position: {"hash": hash_sha, "description": description}
+            for position, hash_sha, description in self.connection.execute(query, (commit_id,))
+        }
+
+    def write_snapshots(self, records: List[Tuple[str, int, Dict[str, Any]]]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO snapshots (commit_id, position, hash, description) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (commit_id, position, snapshot["hash"], snapshot["description"])
+                    for commit_id, position, snapshot in records
+                ],
+            )
+
+
+class ResolutionStore:
+    """Resolved contents of conflicted files, keyed by their conflict pre-image
+    id. Each resolution is a file in `directory`."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def get(self, preimage_id: str) -> Optional[bytes]:
+        path = os.path.join(self.directory, preimage_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def record(self, preimage_id: str, content: bytes) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, preimage_id)
+        temp_filename = f"{path}.tmp"
+        with open(temp_filename, "wb") as f:
+            f.write(content)
+        os.replace(temp_filename, path)
+
+    def clear(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
 class GitGud:
     repo: Repo
     state: RepoState
@@ -351,11 +1413,25 @@ class GitGud:
         state: RepoState,
         hosted_repo: Optional[HostedRepo] = None,
         global_config: Optional[GlobalConfig] = None,
+        state_store: Optional[StateStore] = None,
     ):
         self.repo = repo
         self.state = state
         self.hosted_repo = hosted_repo
         self.global_config = global_config or GlobalConfig()
+        self._state_store = state_store or GitGud.get_state_store(
+            self.state.repo_dir, self.global_config
+        )
+        self._transaction_depth = 0
+        self._state_modified = False
+        self._root_index: Optional[Dict[str, str]] = None
+        self.ancestry = AncestryOracle(repo)
+        self.objects = ObjectReader(repo)
+        self.view = RepoView(repo)
+        self.refs = RefTransaction(repo)
+        self.resolutions = ResolutionStore(
+            GitGud.state_filename(self.state.repo_dir, self.global_config) + ".resolutions"
+        )
 
         if self.state.config.verbose:
             logging.basicConfig(level=logging.INFO)
@@ -364,15 +1440,21 @@ class GitGud:
         return RepoSummary(commit_tree=self.get_commit_summary(self.state.root))
 
     def get_commit_summary(self, commit_id: str) -> CommitSummary:
-        commit = self.get_commit(commit_id)
-        is_head = commit_id == self.state.head
-        summary = CommitSummary(
-            id=commit.id, hash=commit.hash, is_head=is_head, description=commit.description
-        )
-        for child_id in commit.children:
-            child_summary = self.get_commit_summary(child_id)
-            summary.children.append(child_summary)
-        return summary
+        summaries: Dict[str, CommitSummary] = {}
+        parents: Dict[str, CommitSummary] = {}
+        for commit in self.iter_commits(commit_id):
+            summary = CommitSummary(
+                id=commit.id,
+                hash=commit.hash,
+                is_head=commit.id == self.state.head,
+                description=commit.description,
+            )
+            summaries[commit.id] = summary
+            for child_id in commit.children:
+                parents[child_id] = summary
+            if commit.id in parents:
+                parents[commit.id].children.append(summary)
+        return summaries[commit_id]
 
     def get_config(self) -> GitGudConfig:
         return self.state.config
@@ -389,35 +1471,88 @@ class GitGud:
         filename = f"{dirname}_{hash}"
         return os.path.join(global_config.configs_root, filename)
 
+    @staticmethod
+    def get_state_store(directory: str, global_config: Optional[GlobalConfig] = None) -> StateStore:
+        global_config = global_config or GlobalConfig()
+        state_filename = GitGud.state_filename(directory, global_config)
+        if global_config.state_backend == StateBackend.SQLITE:
+            return SqliteStateStore(state_filename)
+        return StateJournal(state_filename)
+
     def save_state(self) -> None:
+        """Persist the state, or defer it to the end of the current transaction."""
+
+        self._state_modified = True
+        self._invalidate_caches()
+        self.view.invalidate()
+        if not self._transaction_depth:
+            self.flush_state()
+
+    def flush_state(self) -> None:
+        """Write any deferred state changes to disk.
+
+        Inside a transaction, this must be called before any operation that may
+        leave git in a state that the stored GitGud state needs to describe."""
+
+        # Refs go first, if they fail the stored state keeps describing the
+        # refs as they were.
+        self.flush_refs()
+        if not self._state_modified:
+            return
+
         os.makedirs(self.global_config.configs_root, exist_ok=True)
-        state_filename = GitGud.state_filename(self.state.repo_dir, self.global_config)
-        with open(state_filename, "w", encoding="utf-8") as out_file:
-            out_file.write(self.state.json(indent=4))
+        self._state_store.save(self.state)
+        self._state_modified = False
+
+    def flush_refs(self) -> None:
+        """Apply the queued ref changes. Must be called before running any git
+        command that reads the refs changed in the current transaction."""
+
+        if self.refs.apply():
+            self.view.invalidate()
+
+    def _read_branch(self, branch: str) -> CommitObject:
+        """Read the commit a branch points to, including queued ref changes."""
+        return self.objects.read_commit(self.refs.resolve(branch))
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Collect state changes in memory and persist them once the outermost
+        transaction finishes, successfully or not."""
+
+        self._transaction_depth += 1
+        try:
+            yield
+        finally:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self.flush_state()
 
     @staticmethod
-    def get_remote_commit(repo: Repo, remote_master: str) -> GudCommit:
+    def get_remote_commit(
+        repo: Repo, remote_master: str, objects: Optional[ObjectReader] = None
+    ) -> GudCommit:
         """Given a repo in a checkout out remote commit, generate the corresponding GudCommit."""
 
+        objects = objects or ObjectReader(repo)
         hash_sha = repo.head.commit.hexsha
         master_commit_id = f"master@{hash_sha[0:8]}"
         new_branch = repo.create_head(master_commit_id)
 
+        # Same commit as HEAD, so no submodules need to be updated.
         run_git_command_with_retries(new_branch.checkout)
-        repo.git.submodule("update", "--init", "--recursive")
 
-        date_str = repo.git.show("-s", "--pretty=%ad", hash_sha, "--date=iso-local")
-        date = datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S %z")
+        commit_object = objects.read_commit(hash_sha)
 
         return GudCommit(
             id=master_commit_id,
-            hash=repo.head.commit.hexsha,
-            description=repo.head.commit.message.strip(),
+            hash=hash_sha,
+            description=commit_object.message.strip(),
             remote=True,
             uploaded=True,
             history_branch=master_commit_id,
             upstream_branch=remote_master,
-            date=date,
+            date=commit_object.author_date,
         )
 
     @staticmethod
@@ -454,7 +1589,9 @@ class GitGud:
             hosted_repo = GitGud.get_hosted_repo(repo_metadata)
 
         repo = Repo.clone_from(remote_repo_path, local_repo_path, progress=Progress())
+        update_submodules(repo, None, repo.head.commit.hexsha)
         root = GitGud.get_remote_commit(repo, repo.active_branch.name)
+        root.generation = 0
 
         state = RepoState(
             repo_dir=local_repo_path,
@@ -465,6 +1602,8 @@ class GitGud:
             global_config=global_config,
         )
         gg = GitGud(repo, state, hosted_repo, global_config=global_config)
+        # Resolutions from a previous clone in the same directory do not apply.
+        gg.resolutions.clear()
         gg.save_state()
         return gg
 
@@ -477,13 +1616,20 @@ class GitGud:
         if not os.path.exists(directory):
             raise ConfigNotFoundError(f"No GitGud state for {directory}.")
 
-        state_file = GitGud.state_filename(directory, global_config)
-        if not os.path.exists(state_file):
+        return GitGud.load_state(directory, GitGud.get_state_store(directory, global_config))
+
+    @staticmethod
+    def load_state(directory: str, state_store: StateStore) -> RepoState:
+        """Load GitGud repo state for the given directory from a state store."""
+
+        if not state_store.exists():
             raise ConfigNotFoundError(f"No GitGud state for {directory}.")
 
-        with open(state_file, encoding="utf-8") as f:
-            obj = json.loads(f.read())
-            return RepoState(**obj)
+        obj = state_store.load()
+        raw_commits = obj.pop("commits")
+        state = RepoState(**obj)
+        state.commits = LazyCommits(raw_commits)
+        return state
 
     @staticmethod
     def for_clean_repo(repo: Repo, global_config: Optional[GlobalConfig] = None) -> "GitGud":
@@ -494,7 +1640,9 @@ class GitGud:
         state = RepoState(
             repo_dir=repo.working_tree_dir, root=root.id, head=root.id, commits={root.id: root}
         )
-        return GitGud(repo, state, global_config=global_config)
+        gg = GitGud(repo, state, global_config=global_config)
+        gg.resolutions.clear()
+        return gg
 
     @staticmethod
     def for_working_dir(working_dir: str, global_config: Optional[GlobalConfig] = None) -> "GitGud":
@@ -504,13 +1652,26 @@ class GitGud:
             raise ConfigNotFoundError(f"No GitGud state for {working_dir}.")
 
         repo = Repo(find_repo_root(Path(working_dir)))
-        repo_state = GitGud.load_state_for_directory(repo.working_tree_dir, global_config)
+        state_store = GitGud.get_state_store(repo.working_tree_dir, global_config)
+        repo_state = GitGud.load_state(repo.working_tree_dir, state_store)
+        state_store.mark_persisted(repo_state)
         hosted_repo = GitGud.get_hosted_repo(repo_state.repo_metadata)
-        return GitGud(repo, repo_state, hosted_repo, global_config=global_config)
+        return GitGud(
+            repo, repo_state, hosted_repo, global_config=global_config, state_store=state_store
+        )
 
     def _checkout(self, branch_name: str) -> None:
+        self.flush_refs()
+        old_hash = self.view.get_head()
+        self.view.invalidate()
         run_git_command_with_retries(self.repo.git.checkout, branch_name, "--recurse-submodules")
-        self.repo.git.submodule("update", "--init", "--recursive")
+        self._update_submodules(old_hash)
+
+    def _update_submodules(self, old_hash: Optional[str]) -> None:
+        """Update the submodules that changed since `old_hash` was checked out."""
+        update_submodules(
+            self.repo, old_hash, self.repo.head.commit.hexsha, self.get_config().submodule_jobs
+        )
 
     def get_oldest_non_remote(self, commit_id: str) -> GudCommit:
         """Given a commit id, find the oldest ancestor that is not remote."""
@@ -541,11 +1702,8 @@ class GitGud:
 
         if all_commits:
 
-            def f(c: GudCommit) -> None:
-                if not c.remote:
-                    self.upload(commit_id=c.id)
-
-            self.traverse(self.root().id, f, skip=False)
+            for c in self.iter_commits(self.root().id, where=lambda c: not c.remote):
+                self.upload(commit_id=c.id)
             return
 
         if not commit_id:
@@ -592,42 +1750,68 @@ class GitGud:
         assert self.hosted_repo is not None
         commit.pull_request = self.hosted_repo.get_pull_request(commit.pull_request.id)
 
+    def _get_generation(self, hash_sha: str) -> Optional[int]:
+        """Generation of a new remote commit, counted from the newest known
+        remote commit it descends from. Only the commits in between are walked.
+
+        States from before generations existed have none to count from. These
+        are seeded with a full count of the commit's history, once.
+
+        Returns None if it descends from none of them, like a commit older than
+        the root."""
+
+        remote_commits = sorted(
+            (c for c in self.state.commits.values() if c.remote and c.generation is not None),
+            key=lambda c: cast(int, c.generation),
+            reverse=True,
+        )
+        if not remote_commits:
+            return int(self.repo.git.rev_list("--count", hash_sha))
+
+        for commit in remote_commits:
+            if self.ancestry.is_ancestor(commit.hash, hash_sha):
+                assert commit.generation is not None
+                return commit.generation + int(
+                    self.repo.git.rev_list("--count", f"{commit.hash}..{hash_sha}")
+                )
+        return None
+
     def comes_before(self, commit_1: GudCommit, commit_2: GudCommit) -> bool:
         """Returns True if commit_1 comes before commit_2."""
-        self._checkout(self.state.master_branch)
-        revcount = int(self.repo.git.rev_list("--count", f"{commit_1.hash}..{commit_2.hash}"))
-        result = revcount > 0
-        return result
+        if commit_1.generation is not None and commit_2.generation is not None:
+            return commit_1.generation < commit_2.generation
+        return not self.ancestry.is_ancestor(commit_2.hash, commit_1.hash)
 
     def _insert_remote_commit(self, commit: GudCommit) -> None:
         logging.info("Inserting remote commit %s", commit.id)
-        parent = self.root()
 
-        next_child = None
+        # The chain of remote commits, from the root to the newest one.
+        chain = [self.root()]
         while True:
-            next_parent: Optional[GudCommit] = None
-
-            for child_id in parent.children:
-                child = self.get_commit(child_id)
-                if not child.remote:
-                    continue
-                next_parent = child
-                break
-
-            if not next_parent:
+            remote_children = [
+                child
+                for child in (self.get_commit(child_id) for child_id in chain[-1].children)
+                if child.remote
+            ]
+            if not remote_children:
                 break
+            chain.append(remote_children[0])
 
-            if not self.comes_before(next_parent, commit):
-                next_child = next_parent
-                break
+        generations = [c.generation for c in chain[1:]]
+        if commit.generation is not None and None not in generations:
+            # Everything that comes before the new commit goes above it.
+            position = bisect.bisect_left(cast(List[int], generations), commit.generation)
+        else:
+            position = 0
+            while position < len(generations) and self.comes_before(chain[position + 1], commit):
+                position += 1
 
-            parent = next_parent
+        parent = chain[position]
+        next_child = chain[position + 1] if position + 1 < len(chain) else None
 
         logging.info("Will insert under %s", parent.id)
         self.state.commits[commit.id] = commit
-        parent.children.append(commit.id)
-        commit.parent_hash = parent.hash
-        commit.parent_id = parent.id
+        self._link(parent, commit)
 
         if next_child:
             self.rebase(source_id=next_child.id, dest_id=commit.id)
@@ -642,11 +1826,14 @@ class GitGud:
             raise ValueError("Missing merge commit SHA")
 
         self._checkout(commit.pull_request.merge_commit_sha)
-        pulled_commit = GitGud.get_remote_commit(self.repo, self.state.master_branch)
+        pulled_commit = GitGud.get_remote_commit(
+            self.repo, self.state.master_branch, self.objects
+        )
 
         if pulled_commit.id in self.state.commits:
             merged_commit = self.get_commit(pulled_commit.id)
         else:
+            pulled_commit.generation = self._get_generation(pulled_commit.hash)
             self._insert_remote_commit(pulled_commit)
             merged_commit = pulled_commit
 
@@ -662,6 +1849,7 @@ class GitGud:
         self.drop_commit(commit.id)
         return merged_commit
 
+    @transactional
     def squash(self, source_id: str, dest_id: str) -> None:
         """Combines two commits into one."""
 
@@ -680,8 +1868,12 @@ class GitGud:
 
         self.drop_commit(source_id)
 
-    def sync(self, all: bool = False) -> GudCommit:
-        """Pull changes from remote and rebase the current commit to a more recent master branch."""
+    @transactional
+    def sync(self, all: bool = False, conflicts: ConflictPolicy = ConflictPolicy.STOP) -> GudCommit:
+        """Pull changes from remote and rebase the current commit to a more recent master branch.
+
+        When syncing all stacks, `conflicts` decides what happens to the stacks
+        predicted to conflict with the new master branch."""
         logging.info("Syncing branch.")
 
         if self.is_dirty():
@@ -689,21 +1881,26 @@ class GitGud:
 
         if all:
             starting_commit_id = self.head().id
-            commit_ids_to_sync: List[str] = []
-
-            for commit_id in sorted(self.state.commits.keys()):
-                commit = self.get_commit(commit_id)
-                if commit.remote:
+            if conflicts == ConflictPolicy.STOP:
+                plan = self.plan_sync()
+            else:
+                plan = self.plan_sync(onto_hash=self.pull_remote(prune=False).hash)
+
+            stacks = plan.stacks
+            conflicting = [stack for stack in stacks if stack.conflicts]
+            self._print_conflicts([c for stack in conflicting for c in stack.conflicts])
+            if conflicts == ConflictPolicy.DEFER:
+                stacks = [stack for stack in stacks if not stack.conflicts] + conflicting
+            elif conflicts == ConflictPolicy.SKIP:
+                stacks = [stack for stack in stacks if not stack.conflicts]
+
+            logging.info("Will sync commits %s", [stack.root_id for stack in stacks])
+            for stack in stacks:
+                if stack.root_id not in self.state.commits:
+                    logging.info("Skipping %s, it was removed while syncing", stack.root_id)
                     continue
-                non_remote_ancestor = self.get_oldest_non_remote(commit_id).id
-
-                if non_remote_ancestor not in commit_ids_to_sync:
-                    # We are not using a set here just to have deterministic results
-                    commit_ids_to_sync.append(non_remote_ancestor)
 
-            logging.info("Will sync commits %s", commit_ids_to_sync)
-            for commit_id in commit_ids_to_sync:
-                self.update(commit_id)
+                self.update(stack.root_id)
                 self.sync(all=False)
 
                 if self.state.merge_conflict_state:
@@ -746,6 +1943,82 @@ class GitGud:
         self.save_state()
         return new_remote_commit
 
+    def plan_sync(self, onto_hash: Optional[str] = None) -> SyncPlan:
+        """Find every local stack and the commits in it with a single pass over
+        the commit tree.
+
+        Stacks are ordered by their smallest commit id, so that the results are
+        deterministic. If `onto_hash` is given, the conflicts of rebasing each
+        stack onto it are predicted too."""
+
+        stacks: Dict[str, SyncStack] = {}
+        stack_of: Dict[str, SyncStack] = {}
+        commits = (c for root in self.get_roots() for c in self.iter_commits(root.id))
+        for commit in commits:
+            if commit.remote:
+                continue
+
+            parent_id = commit.parent_id
+            if parent_id in stack_of:
+                stack = stack_of[parent_id]
+            else:
+                stack = stacks[commit.id] = SyncStack(root_id=commit.id)
+
+            stack_of[commit.id] = stack
+            stack.commit_ids.append(commit.id)
+
+        if onto_hash is not None:
+            for stack in stacks.values():
+                stack.conflicts = self.predict_conflicts(stack.root_id, onto_hash)
+
+        return SyncPlan(stacks=sorted(stacks.values(), key=lambda stack: min(stack.commit_ids)))
+
+    def predict_conflicts(self, commit_id: str, onto_hash: str) -> List[PredictedConflict]:
+        """Dry run of rebasing a commit and all its descendants onto `onto_hash`,
+        reporting every commit and file that would conflict. Only the object
+        database is used, no branches or files are changed.
+
+        A conflicting commit is assumed to be resolved to its current tree, so
+        that its descendants can still be checked."""
+
+        conflicts = []
+        new_hashes: Dict[str, str] = {}
+        for commit in self.iter_commits(commit_id):
+            if commit.remote:
+                continue
+
+            source = self._read_branch(commit.id)
+            if commit.parent_hash is None or len(source.parents) != 1:
+                new_hashes[commit.id] = source.hash
+                continue
+
+            if commit.id == commit_id:
+                onto = onto_hash
+            else:
+                assert commit.parent_id is not None
+                onto = new_hashes[commit.parent_id]
+
+            # Branches with several git commits are replayed all at once.
+            tree, files = self._replay_tree(source.hash, commit.parent_hash, onto)
+            if files:
+                conflicts.append(PredictedConflict(commit_id=commit.id, files=files))
+                tree = source.tree
+
+            new_hashes[commit.id] = self.repo.git.commit_tree(
+                tree, "-p", onto, "-m", "gg conflict prediction"
+            )
+
+        return conflicts
+
+    def _print_conflicts(self, conflicts: List[PredictedConflict]) -> None:
+        if not conflicts:
+            return
+
+        print("Expected merge conflicts:")
+        for conflict in conflicts:
+            print(f"  - {conflict.commit_id}: [bold red]{', '.join(conflict.files)}[/bold red]")
+        print("")
+
     def prune_commits(self) -> None:
         """Clean up irrelevant commits.
 
@@ -759,73 +2032,81 @@ class GitGud:
 
         to_prune: List[str] = []
         for commit_id, commit in self.state.commits.items():
-            non_remote_children = list(
-                filter(lambda child_id: not self.get_commit(child_id).remote, commit.children)
-            )
-            if commit.children and commit.remote and not non_remote_children:
+            if not commit.remote or not commit.children:
+                continue
+            if all(self.get_commit(child_id).remote for child_id in commit.children):
                 to_prune.append(commit_id)
 
         for commit_to_prune_id in to_prune:
             logging.info("Prunning commit %s", commit_to_prune_id)
             commit_to_prune = self.get_commit(commit_to_prune_id)
-
-            for commit_id, commit in self.state.commits.items():
-                if commit.parent_id == commit_to_prune_id:
-
-                    if not self.state.root == commit_to_prune.id:
-                        assert commit_to_prune.parent_id is not None
-                        parent_of_prunned = self.get_commit(commit_to_prune.parent_id)
-                        commit.parent_id = parent_of_prunned.id
-                        commit.parent_hash = parent_of_prunned.hash
-                        parent_of_prunned.children.append(commit.id)
-                    else:
-                        commit.parent_id = None
-                        commit.parent_hash = None
-
-                if commit_to_prune_id in commit.children:
-                    commit.children.remove(commit_to_prune_id)
+            children = [self.get_commit(child_id) for child_id in commit_to_prune.children]
 
             if self.state.root == commit_to_prune.id:
-                self.state.root = commit_to_prune.children[0]
+                self.state.root = children[0].id
+                for child in children:
+                    self._unlink(child)
+            else:
+                assert commit_to_prune.parent_id is not None
+                parent_of_prunned = self.get_commit(commit_to_prune.parent_id)
+                self._unlink(commit_to_prune)
+                for child in children:
+                    self._link(parent_of_prunned, child)
 
             self.state.commits.pop(commit_to_prune_id)
-            self.repo.git.branch("-D", commit_to_prune.id)
+            self._detach_from(commit_to_prune.id)
+            self.refs.delete(commit_to_prune.id)
 
     def pull_remote(self, prune: bool = True) -> GudCommit:
         """Pulls the latest commit from remote master and adds it as a child of
         the most recent remote commit."""
 
         # Get the newest remote commit
+        remote_commits = [commit for commit in self.state.commits.values() if commit.remote]
+        if not remote_commits:
+            raise ValueError("No remote commits")
+
+        if all(commit.generation is not None for commit in remote_commits):
+            newest_hash: Optional[str] = max(
+                remote_commits, key=lambda commit: cast(int, commit.generation)
+            ).hash
+        else:
+            newest_hash = self.ancestry.newest([commit.hash for commit in remote_commits])
+
         newest_remote = None
-        for commit in self.state.commits.values():
-            if commit.remote:
-                if not newest_remote:
+        for commit in remote_commits:
+            if newest_hash is not None:
+                if commit.hash == newest_hash:
                     newest_remote = commit
-                    continue
+                    break
+                continue
 
-                if self.comes_before(newest_remote, commit):
-                    newest_remote = commit
-                    continue
+            # Diverged history, fall back to comparing commits one by one.
+            if not newest_remote or self.comes_before(newest_remote, commit):
+                newest_remote = commit
 
-        if not newest_remote:
-            raise ValueError("No remote commits")
+        assert newest_remote is not None
 
         logging.info("Starting of more recent remote commit %s", newest_remote.id)
+        self.flush_state()
 
         self._checkout(self.state.master_branch)
+        old_hash = self.view.get_head()
+        self.view.invalidate()
         run_git_command_with_retries(
             self.repo.git.pull, "--rebase", "origin", self.state.master_branch
         )
-        run_git_command_with_retries(self.repo.git.submodule, "update", "--init", "--recursive")
-        pulled_commit = GitGud.get_remote_commit(self.repo, self.state.master_branch)
+        self._update_submodules(old_hash)
+        pulled_commit = GitGud.get_remote_commit(
+            self.repo, self.state.master_branch, self.objects
+        )
         if pulled_commit.id == newest_remote.id:
             logging.info("Nothing to do, already at latest remote HEAD")
             return newest_remote
 
+        pulled_commit.generation = self._get_generation(pulled_commit.hash)
         self.state.commits[pulled_commit.id] = pulled_commit
-        newest_remote.children.insert(0, pulled_commit.id)
-        pulled_commit.parent_hash = newest_remote.hash
-        pulled_commit.parent_id = newest_remote.id
+        self._link(newest_remote, pulled_commit, first=True)
         if prune:
             self.prune_commits()
         self.update(pulled_commit.id)
@@ -835,12 +2116,56 @@ class GitGud:
     def traverse(
         self, commit_id: str, func: Callable[[GudCommit], None], skip: bool = False
     ) -> None:
-        commit = self.get_commit(commit_id)
-        if not skip:
+        for commit in self.iter_commits(commit_id, skip=skip):
             func(commit)
 
-        for c in commit.children:
-            self.traverse(c, func)
+    def iter_commits(
+        self,
+        commit_id: Optional[str] = None,
+        order: TraversalOrder = TraversalOrder.PRE_ORDER,
+        where: Optional[Callable[[GudCommit], bool]] = None,
+        skip: bool = False,
+    ) -> Iterator[GudCommit]:
+        """Iterate over a commit and all its descendants.
+
+        Children are only read when their parent is expanded, after the parent
+        itself has been yielded in pre-order and BFS, so callers may stop at any
+        point or modify the commits they receive. Only commits matching `where`
+        are yielded, but the rest are still traversed. With `skip`, the starting
+        commit is not yielded."""
+
+        start_id = commit_id or self.state.root
+
+        def accept(commit: GudCommit) -> bool:
+            if skip and commit.id == start_id:
+                return False
+            return where is None or where(commit)
+
+        if order == TraversalOrder.BFS:
+            queue = deque([start_id])
+            while queue:
+                commit = self.get_commit(queue.popleft())
+                if accept(commit):
+                    yield commit
+                queue.extend(commit.children)
+        elif order == TraversalOrder.PRE_ORDER:
+            stack = [start_id]
+            while stack:
+                commit = self.get_commit(stack.pop())
+                if accept(commit):
+                    yield commit
+                stack.extend(reversed(commit.children))
+        else:
+            expanded: List[Tuple[str, bool]] = [(start_id, False)]
+            while expanded:
+                current_id, children_done = expanded.pop()
+                commit = self.get_commit(current_id)
+                if children_done:
+                    if accept(commit):
+                        yield commit
+                    continue
+                expanded.append((current_id, True))
+                expanded.extend((child_id, False) for child_id in reversed(commit.children))
 
     def serialize(self) -> Dict:
         return {
@@ -848,6 +2173,7 @@ class GitGud:
         }
 
     def add_changes_to_index(self) -> None:
+        self.view.invalidate()
         run_git_command_with_retries(self.repo.git.add, "-A")
 
     def commit(
@@ -869,6 +2195,7 @@ class GitGud:
         if all:
             self.add_changes_to_index()
 
+        self.view.invalidate()
         commit = self.repo.index.commit(commit_msg)
         gud_commit = GudCommit(
             id=branch_name,
@@ -879,20 +2206,18 @@ class GitGud:
             parent_id=self.head().id,
             uploaded=False,
         )
-        gud_commit.snapshots.append(gud_commit.get_metadata_for_snapshot())
-
-        if self.head():
-            self.head().children.append(gud_commit.id)
+        self._add_snapshot(gud_commit, gud_commit.get_metadata_for_snapshot())
+        self.state.commits[gud_commit.id] = gud_commit
+        self._link(self.head(), gud_commit)
 
         self.state.head = gud_commit.id
         logging.info("Created commit (%s): %s", gud_commit.id, get_oneliner(commit_msg))
-        self.state.commits[gud_commit.id] = gud_commit
 
         if use_existing_history_branch:
             self._checkout(use_existing_history_branch)
 
         logging.info("Creating history branch: %s", history_branch_name)
-        self.repo.create_head(history_branch_name)
+        self.refs.create(history_branch_name, self.repo.head.commit.hexsha)
 
         self.save_state()
         return gud_commit
@@ -904,7 +2229,7 @@ class GitGud:
             raise ValueError("Cannot restore snapshot during merge conflict.")
 
         snapshot = None
-        for snapshot in self.head().snapshots:
+        for snapshot in self.get_snapshots(self.head().id):
             if snapshot.hash == snapshot_hash:
                 break
 
@@ -916,33 +2241,38 @@ class GitGud:
         self.amend(f"Restore snapshot {snapshot.hash} - {snapshot.description}")
 
     def _copy_branch_state(self, source_branch: str, dest_branch: str) -> None:
-        temp_branch_name = "temp_" + dest_branch
-        run_git_command_with_retries(self.repo.git.switch, "-c", temp_branch_name, source_branch)
-        run_git_command_with_retries(self.repo.git.reset, "--soft", dest_branch)
-        run_git_command_with_retries(self.repo.git.branch, "-M", dest_branch)
+        """Check out `dest_branch` with the index and working tree of `source_branch`."""
+
+        self.flush_refs()
+        self.view.invalidate()
+        run_git_command_with_retries(self.repo.git.read_tree, "-m", "-u", "HEAD", source_branch)
+        self.repo.git.symbolic_ref("HEAD", f"refs/heads/{dest_branch}")
+
+    def get_snapshots(self, commit_id: str) -> List[Snapshot]:
+        """Returns the snapshots of the given commit, oldest first."""
+
+        commit = self.get_commit(commit_id)
+        return self._state_store.get_snapshots(commit.id, commit.snapshot_count)
+
+    def _add_snapshot(self, commit: GudCommit, snapshot: Snapshot) -> None:
+        self._state_store.append_snapshot(commit.id, commit.snapshot_count, snapshot)
+        commit.snapshot_count += 1
+        commit.latest_snapshot = snapshot
 
     def snapshot(self, message: str = "", commit: bool = True) -> None:
         """Take a snapshot of the current commit state and add it to the history branch."""
 
-        snapshot_message = f"Snapshot #{len(self.head().snapshots)}"
+        snapshot_message = f"Snapshot #{self.head().snapshot_count}"
         if message:
             snapshot_message += f": {message}"
 
         if commit:
             history_branch = self.head().history_branch
             assert history_branch is not None
-            self._copy_branch_state(self.head().id, history_branch)
-
-            # only add a history commit if there were changes from the main branch
-            changes = False
-            diff_list = self.repo.head.commit.diff()
-            for _ in diff_list:
-                changes = True
-
-            if changes:
-                self.repo.git.commit("-m", snapshot_message)
+            hash = self._commit_to_history(history_branch, self.head().id, snapshot_message)
+        else:
+            hash = self.repo.head.commit.hexsha
 
-        hash = self.repo.head.commit.hexsha
         new_snapshot = Snapshot(hash=hash, description=snapshot_message)
         logging.info(
             "Taking snapshot for %s: %s - %s",
@@ -950,10 +2280,34 @@ class GitGud:
             new_snapshot.hash,
             new_snapshot.description,
         )
-        self.head().snapshots.append(new_snapshot)
-        self._checkout(self.head().id)
+        self._add_snapshot(self.head(), new_snapshot)
         self.save_state()
 
+    def _commit_to_history(
+        self, history_branch: str, source: str, message: str, merged: Optional[List[str]] = None
+    ) -> str:
+        """Record the tree of `source` on top of the history branch, without
+        touching the working tree or the index. Returns the new tip of the
+        history branch.
+
+        With `merged`, the new commit is a merge of those commits into the
+        history branch. Its tree is still the one from `source`, so no merge
+        needs to be computed.
+
+        Only adds a history commit if there were changes from the history branch."""
+
+        history_tip = self._read_branch(history_branch)
+        tree = self.objects.tree(self.refs.resolve(source))
+        if tree == history_tip.tree:
+            return history_tip.hash
+
+        parents = [history_tip.hash] + (merged or [])
+        parent_args = [arg for parent in parents for arg in ("-p", parent)]
+        new_hash = self.repo.git.commit_tree(tree, *parent_args, "-m", message)
+        self._detach_from(history_branch)
+        self.refs.update(history_branch, new_hash, history_tip.hash)
+        return new_hash
+
     def amend(self, message: str = "") -> None:
         """Amend the commit with current changes, updates hash.
 
@@ -977,6 +2331,7 @@ class GitGud:
         logging.info("Amending commit %s", self.head().id)
 
         self.add_changes_to_index()
+        self.view.invalidate()
         self.repo.git.commit("--amend", "--no-edit", "--allow-empty")
 
         new_hash = self.repo.head.commit.hexsha
@@ -1002,23 +2357,41 @@ class GitGud:
     def root(self) -> GudCommit:
         return self.get_commit(self.state.root)
 
+    @transactional
     def execute_pending_operations(self) -> None:
         """Execute all the operations that were queued in the gg state."""
 
+        if not self.state.pending_operations:
+            return
+
+        self._check_can_update()
         count = 0
         total_ops = len(self.state.pending_operations)
 
-        while self.state.pending_operations:
-            count += 1
-            op = self.state.pending_operations.pop(0)
-            logging.info("Executing op %s of %s: %s", count, total_ops, op)
-            if op.type == OperationType.EVOLVE:
-                self.update(op.evolve_op.base_commit_id)
-                self.evolve(op.evolve_op.target_commit_id)
-                if self.state.merge_conflict_state:
-                    self.save_state()
-                    break
-            self.save_state()
+        try:
+            while self.state.pending_operations:
+                count += 1
+                op = self.state.pending_operations.pop(0)
+                logging.info("Executing op %s of %s: %s", count, total_ops, op)
+                if op.type == OperationType.EVOLVE:
+                    # Evolving only needs the base commit as the head of the state,
+                    # the working tree is not used unless there's a conflict.
+                    self.state.head = op.evolve_op.base_commit_id
+                    self.evolve(op.evolve_op.target_commit_id)
+                    if self.state.merge_conflict_state:
+                        self.flush_state()
+                        break
+                self.save_state()
+        except Exception:
+            # Keep the state pointing to what is checked out.
+            if not self.repo.head.is_detached:
+                branch = self.repo.active_branch.name
+                if branch in self.state.commits:
+                    self.state.head = branch
+            raise
+
+        if not self.state.merge_conflict_state:
+            self._checkout_head()
 
     def enqueue_op(self, operation: PendingOperation) -> None:
         self.state.pending_operations.append(operation)
@@ -1031,23 +2404,22 @@ class GitGud:
 
         logging.info("Scheduling recursive evolve for %s", commit.id)
 
-        def f(c: GudCommit) -> None:
+        for c in self.iter_commits(commit.id):
             for child_id in c.children:
                 child_commit = self.get_commit(child_id)
-                if mark_as_needed and not child_commit.remote:
-                    child_commit.needs_evolve = True
-                    self.get_commit(child_id).needs_evolve = True
-
-                if not child_commit.remote:
-                    operation = PendingOperation(
-                        type=OperationType.EVOLVE,
-                        evolve_op=EvolveOperation(base_commit_id=c.id, target_commit_id=child_id),
-                    )
+                if child_commit.remote:
+                    continue
 
-                    self.enqueue_op(operation)
+                if mark_as_needed:
+                    child_commit.needs_evolve = True
 
-        self.traverse(commit.id, f)
+                operation = PendingOperation(
+                    type=OperationType.EVOLVE,
+                    evolve_op=EvolveOperation(base_commit_id=c.id, target_commit_id=child_id),
+                )
+                self.enqueue_op(operation)
 
+    @transactional
     def evolve(self, target_commit_id: Optional[str] = None) -> None:
         """Propagate changes of amended commit onto all descendants."""
 
@@ -1068,6 +2440,9 @@ class GitGud:
             if not child:
                 raise ValueError(f"{target_commit_id} it not a child of {self.head().id}")
         else:
+            self._check_can_update()
+            for child_id in self.head().children:
+                self._print_conflicts(self.predict_conflicts(child_id, self.head().hash))
             self.schedule_recursive_evolve(self.head())
             self.execute_pending_operations()
             return
@@ -1078,23 +2453,154 @@ class GitGud:
             return
 
         logging.info("Evolving %s to %s", self.head().id, child.id)
+        if self._evolve_by_ref_update(child, self.head()):
+            return
 
         try:
-            run_git_command_with_retries(
-                self.repo.git.rebase,
-                "--onto",
-                self.head().hash,
-                child.parent_hash,
-                child.id,
-            )
+            if not self._rebase_in_memory(child, self.head().hash):
+                # git may stop on a conflict, the stored state must describe
+                # the refs it starts from.
+                self.flush_state()
+                old_hash = self.view.get_head()
+                self.view.invalidate()
+                run_git_command_with_retries(
+                    self.repo.git.rebase,
+                    "--onto",
+                    self.head().hash,
+                    child.parent_hash,
+                    child.id,
+                )
+                self._update_submodules(old_hash)
 
-            run_git_command_with_retries(self.repo.git.submodule, "update", "--init", "--recursive")
             self.continue_evolve(
                 target_commit_id, self.head().id, f"Evolved changes from {self.head().id}"
             )
         except GitCommandError as e:
             self.handle_merge_conflict(self.head(), child, e)
 
+    def _evolve_by_ref_update(self, child: GudCommit, parent: GudCommit) -> bool:
+        """Evolve a child whose parent tree did not change, e.g. after a message
+        only or empty amend. The rebased commit would have the same tree, so the
+        child is re-parented with a ref update, skipping the rebase, the history
+        merge and the snapshot.
+
+        Returns False when the child needs a real rebase."""
+
+        source = self._read_branch(child.id)
+        if child.parent_hash is None or source.parents != [child.parent_hash]:
+            return False
+
+        if child.parent_hash != parent.hash:
+            if self.objects.tree(child.parent_hash) != self.objects.tree(parent.hash):
+                return False
+
+            with modified_environ(**source.get_author_environ()):
+                new_hash = self.repo.git.commit_tree(
+                    source.tree, "-p", parent.hash, "-m", source.message.rstrip("\n")
+                )
+            self._detach_from(child.id)
+            self.refs.update(child.id, new_hash, source.hash)
+            child.hash = new_hash
+            child.uploaded = False
+
+        logging.info("Tree of %s is unchanged, re-parented %s", parent.id, child.id)
+        self._link(parent, child)
+        self.state.head = child.id
+        child.needs_evolve = False
+        self._finish_evolve()
+        return True
+
+    def _is_single_commit(self, commit: GudCommit) -> bool:
+        """Whether the branch of a commit is a single git commit on top of its parent."""
+
+        source = self._read_branch(commit.id)
+        return commit.parent_hash is not None and source.parents == [commit.parent_hash]
+
+    def _rebase_in_memory(self, commit: GudCommit, onto_hash: str) -> bool:
+        """Rebase the branch of a commit onto `onto_hash` without touching the
+        working tree, using the object database only.
+
+        Returns False when this is not possible, like on merge conflicts, in
+        which case the caller must fall back to `git rebase`."""
+
+        if not self._is_single_commit(commit):
+            logging.info("Cannot rebase %s in memory, not a single commit", commit.id)
+            return False
+
+        assert commit.parent_hash is not None
+        source = self._read_branch(commit.id)
+        old_base = commit.parent_hash
+        if old_base == onto_hash:
+            return True
+
+        onto_tree = self.objects.tree(onto_hash)
+        try:
+            tree, files = self._replay_tree(source.hash, old_base, onto_hash)
+        except GitCommandError as e:
+            logging.info("Cannot rebase %s in memory: %s", commit.id, e)
+            return False
+
+        if files:
+            logging.info("Cannot rebase %s in memory, conflicts in %s", commit.id, files)
+            return False
+
+        if tree == onto_tree and source.tree != self.objects.tree(old_base):
+            # Like `git rebase`, drop changes that are already in the new base.
+            new_hash = onto_hash
+        else:
+            with modified_environ(**source.get_author_environ()):
+                new_hash = self.repo.git.commit_tree(
+                    tree, "-p", onto_hash, "-m", source.message.rstrip("\n")
+                )
+
+        self._detach_from(commit.id)
+        self.refs.update(commit.id, new_hash, source.hash)
+        return True
+
+    def _replay_tree(
+        self, source_hash: str, old_base: str, onto_hash: str
+    ) -> Tuple[str, List[str]]:
+        """Compute the tree of replaying the changes of `source_hash` since
+        `old_base` on top of `onto_hash`, and the files that conflict.
+
+        merge-tree picks the merge base itself. A commit with the new and old
+        bases as its parents makes the old base the merge base, which gives the
+        same result as a cherry-pick."""
+
+        base = self.repo.git.commit_tree(
+            self.objects.tree(onto_hash), "-p", onto_hash, "-p", old_base, "-m", "gg rebase base"
+        )
+        status, stdout, stderr = self.repo.git.merge_tree(
+            "--write-tree",
+            "--name-only",
+            "-z",
+            base,
+            source_hash,
+            with_extended_output=True,
+            with_exceptions=False,
+        )
+        if status not in (0, 1):
+            raise GitCommandError(["git", "merge-tree", base, source_hash], status, stderr)
+
+        # Output is the tree, the conflicted files and an empty field before
+        # the informational messages, all NUL separated.
+        fields = stdout.split("\0\0")[0].split("\0")
+        return fields[0], [f for f in fields[1:] if f]
+
+    def _checkout_head(self) -> None:
+        """Check out the head commit, unless it is already checked out."""
+
+        if self.repo.head.is_detached or self.repo.active_branch.name != self.state.head:
+            self._checkout(self.state.head)
+
+    def _detach_from(self, branch_name: str) -> None:
+        """Detach HEAD if `branch_name` is checked out, so that the branch can be
+        moved without leaving the working tree out of sync. Files are not changed."""
+
+        if not self.repo.head.is_detached and self.repo.active_branch.name == branch_name:
+            self.view.invalidate()
+            self.repo.git.checkout("--detach")
+
     def handle_merge_conflict(
         self, current: GudCommit, incoming: GudCommit, error: GitCommandError
     ) -> None:
@@ -1102,6 +2608,7 @@ class GitGud:
         internal state."""
 
         logging.info("Merge conflict")
+        self.view.invalidate()
         lines = error.stdout.split("\n")
         files = []
         for line in lines:
@@ -1112,8 +2619,68 @@ class GitGud:
             raise InternalError(f"Unknown error: {error.stdout}") from error
 
         self.merge_conflict_begin(current, incoming, files)
+        if self._apply_resolutions():
+            logging.info("Reusing recorded resolutions for %s", files)
+            self.rebase_continue()
+            return
+
         self.save_state()
+        self.flush_state()
+
+    def _apply_resolutions(self) -> bool:
+        """Replace the conflicted files with their recorded resolutions.
+
+        Returns True if every conflicted file was resolved. Otherwise no file
+        is changed, and the pre-images are kept to record the resolutions
+        once the conflict is resolved by hand."""
+
+        assert self.state.merge_conflict_state is not None
+        if not self.state.config.reuse_resolutions:
+            return False
+
+        conflict = self.state.merge_conflict_state
+        resolutions = {}
+        for file in conflict.files:
+            path = os.path.join(self.state.repo_dir, file)
+            if not os.path.exists(path):
+                continue
+
+            with open(path, "rb") as f:
+                preimage_id = get_conflict_preimage_id(f.read())
+            if preimage_id is None:
+                continue
+
+            conflict.preimages[file] = preimage_id
+            resolution = self.resolutions.get(preimage_id)
+            if resolution is not None:
+                resolutions[file] = resolution
+
+        if len(resolutions) != len(conflict.files):
+            return False
+
+        for file, resolution in resolutions.items():
+            with open(os.path.join(self.state.repo_dir, file), "wb") as f:
+                f.write(resolution)
+        return True
+
+    def _record_resolutions(self) -> None:
+        """Record the contents of the conflicted files that have been resolved."""
 
+        assert self.state.merge_conflict_state is not None
+        if not self.state.config.reuse_resolutions:
+            return
+
+        for file, preimage_id in self.state.merge_conflict_state.preimages.items():
+            path = os.path.join(self.state.repo_dir, file)
+            if not os.path.exists(path):
+                continue
+
+            with open(path, "rb") as f:
+                content = f.read()
+            if get_conflict_preimage_id(content) is None:
+                self.resolutions.record(preimage_id, content)
+
+    @transactional
     def rebase(self, source_id: str, dest_id: str) -> None:
         """Change the parent commit of the given source commit to be the
         destination commit."""
@@ -1134,31 +2701,40 @@ class GitGud:
                     f"{dest_commit.id} does not come before {source_commit.id}, cannot rebase"
                 )
 
-            if source_commit.parent_id:
-                self.get_commit(source_commit.parent_id).children.remove(source_commit.id)
-
-            dest_commit.children.append(source_commit.id)
-            source_commit.parent_id = dest_commit.id
-            source_commit.parent_hash = dest_commit.hash
+            self._link(dest_commit, source_commit)
             return
 
         assert source_commit.parent_id is not None
+        message = f"Rebased from {source_commit.parent_id} to {dest_commit.id}"
+        self._print_conflicts(self.predict_conflicts(source_commit.id, dest_commit.hash))
 
         try:
+            if self._is_single_commit(source_commit):
+                rebased = self._rebase_in_memory(source_commit, dest_commit.hash)
+            else:
+                # The branch has more git commits than merge-tree can replay,
+                # git rebases all of them and the whole stack in one go.
+                rebased = False
+                chain = self._get_linear_chain(source_commit)
+                if chain and self._rebase_stack(chain, dest_commit, message):
+                    logging.info("Switching to update %s", source_id)
+                    self.update(source_id)
+                    return
+
             self.schedule_recursive_evolve(source_commit, mark_as_needed=True)
-            run_git_command_with_retries(
-                self.repo.git.rebase,
-                "--onto",
-                dest_commit.hash,
-                source_commit.parent_hash,
-                source_commit.id,
-            )
-            self.repo.git.submodule("update", "--init", "--recursive")
-            self.continue_evolve(
-                source_commit.id,
-                dest_commit.id,
-                f"Rebased from {source_commit.parent_id} to {dest_commit.id}",
-            )
+            self.flush_state()
+            if not rebased:
+                old_hash = self.view.get_head()
+                self.view.invalidate()
+                run_git_command_with_retries(
+                    self.repo.git.rebase,
+                    "--onto",
+                    dest_commit.hash,
+                    source_commit.parent_hash,
+                    source_commit.id,
+                )
+                self._update_submodules(old_hash)
+            self.continue_evolve(source_commit.id, dest_commit.id, message)
             self.execute_pending_operations()
 
             if self.state.merge_conflict_state:
@@ -1169,6 +2745,82 @@ class GitGud:
         except GitCommandError as e:
             self.handle_merge_conflict(dest_commit, source_commit, e)
 
+    def _get_linear_chain(self, commit: GudCommit) -> List[GudCommit]:
+        """Returns the commit and all its descendants if they form a single
+        line of local commits, or an empty list otherwise."""
+
+        chain = [commit]
+        while chain[-1].children:
+            if len(chain[-1].children) > 1:
+                return []
+            child = self.get_commit(chain[-1].children[0])
+            if child.remote:
+                return []
+            chain.append(child)
+        return chain
+
+    def _rebase_stack(self, chain: List[GudCommit], dest: GudCommit, message: str) -> bool:
+        """Rebase a linear chain of commits onto `dest` with a single
+        `git rebase --update-refs`, then update the state of all of them. Used
+        when the first commit can't be rebased in memory because its branch
+        has more than one git commit.
+
+        Returns False if git stops, for example on a conflict. The rebase is
+        then aborted, leaving everything as it was."""
+
+        first, tip = chain[0], chain[-1]
+        logging.info("Rebasing stack %s..%s onto %s", first.id, tip.id, dest.id)
+        self.flush_state()
+        history_hashes = {
+            c.history_branch: self._read_branch(c.history_branch).hash
+            for c in chain
+            if c.history_branch
+        }
+
+        old_hash = self.view.get_head()
+        self.view.invalidate()
+        try:
+            self.repo.git.rebase(
+                "--update-refs", "--onto", dest.hash, first.parent_hash, tip.id
+            )
+        except GitCommandError as e:
+            logging.info("Stack rebase stopped, aborting: %s", e)
+            try:
+                self.repo.git.rebase("--abort")
+            except GitCommandError:
+                # The rebase didn't start.
+                pass
+            self.view.invalidate()
+            return False
+        self._update_submodules(old_hash)
+
+        # --update-refs also moves history branches that pointed to a rebased
+        # commit, those keep their own history.
+        refs = self.view.get_refs()
+        for history_branch, history_hash in history_hashes.items():
+            if refs[history_branch].hash != history_hash:
+                self.refs.update(history_branch, history_hash, refs[history_branch].hash)
+
+        parent = dest
+        for commit in chain:
+            assert commit.history_branch is not None and parent.history_branch is not None
+            self._link(parent, commit)
+            commit.hash = refs[commit.id].hash
+            commit.needs_evolve = False
+            commit.uploaded = False
+
+            parent_history = self._read_branch(parent.history_branch).hash
+            self._commit_to_history(commit.history_branch, commit.hash, message, [parent_history])
+            self.state.head = commit.id
+            self.snapshot(message)
+
+            message = f"Evolved changes from {commit.id}"
+            parent = commit
+
+        self.prune_commits()
+        self.save_state()
+        return True
+
     def drop_commit(self, commit_id: str) -> None:
         """Drop a commit and close the associated pull request."""
 
@@ -1193,10 +2845,7 @@ class GitGud:
             if commit.pull_request.state not in ("MERGED", "CLOSED"):
                 self.hosted_repo.close_pull_request(commit.pull_request.id)
 
-        for other_commit in self.state.commits.values():
-            if commit.id in other_commit.children:
-                other_commit.children.remove(commit.id)
-
+        self._unlink(commit)
         self.state.commits.pop(commit.id)
         self.save_state()
 
@@ -1206,51 +2855,26 @@ class GitGud:
         """
         child = self.get_commit(target_commit_id)
         parent = self.get_commit(parent_id)
+        self._link(parent, child)
 
-        if parent.id != child.parent_id:
-            assert child.parent_id is not None
-            if child.id in self.state.commits[child.parent_id].children:
-                self.state.commits[child.parent_id].children.remove(child.id)
-            if child.id not in parent.children:
-                parent.children.append(child.id)
-
-        child.parent_hash = parent.hash
-        child.parent_id = parent.id
-        if child.id not in parent.children:
-            parent.children.append(child.id)
-
-        self.update(child.id)
-        child.hash = self.repo.head.commit.hexsha
-        self.head().needs_evolve = False
-        self.head().uploaded = False
-        self.head().hash = self.repo.head.commit.hexsha
+        self.state.head = child.id
+        child.hash = self._read_branch(child.id).hash
+        child.needs_evolve = False
+        child.uploaded = False
 
         # Merge commit histories
-        assert child.history_branch is not None
-        self._checkout(child.history_branch)
+        assert child.history_branch is not None and parent.history_branch is not None
         commit_msg = commit_msg or f"Merge commit {parent.id}"
-        try:
-            self.repo.git.merge("--no-ff", "--no-commit", parent.history_branch)
-            if self.repo.index.diff(self.repo.head.commit):
-                # if there are changes to commit, do it
-                run_git_command_with_retries(self.repo.git.commit, "-m", commit_msg)
-        except GitCommandError as e:
-            assert "CONFLICT" in e.stdout
+        parent_history = self._read_branch(parent.history_branch).hash
+        self._commit_to_history(child.history_branch, child.hash, commit_msg, [parent_history])
 
-            # This is just a quick way to get out the merge state, we amend this
-            # commit right after. This is because we can't do `_copy_branch_state()`
-            # during conflict resolution since it switches branches.
-            self.repo.git.checkout(child.id, ".")
-            self.repo.git.add("-A")
-            self.repo.git.commit("-m", commit_msg)
+        self.snapshot(commit_msg)
+        self._finish_evolve()
 
-            # We get the actual desired state.
-            assert child.history_branch is not None
-            self._copy_branch_state(child.id, child.history_branch)
-            self.repo.git.commit("--amend", "-a", "--no-edit")
+    def _finish_evolve(self) -> None:
+        """Run the remaining queued operations, then check out the final head
+        unless they stopped on a merge conflict."""
 
-        self._checkout(child.id)
-        self.snapshot(commit_msg)
         self.save_state()
         self.execute_pending_operations()
 
@@ -1258,6 +2882,7 @@ class GitGud:
             self.save_state()
             return
 
+        self._checkout_head()
         self.prune_commits()
         self.save_state()
 
@@ -1271,8 +2896,8 @@ class GitGud:
         self.repo.git.pull("--rebase", "origin", self.state.master_branch)
         self.repo.git.fetch()
 
-        all_branches = self.repo.git.for_each_ref("--format=%(refname:short)").split("\n")
-        if f"origin/{remote_branch_name}" not in all_branches:
+        self.view.invalidate()
+        if f"origin/{remote_branch_name}" not in self.view.get_refs():
             raise ValueError(f"Unknown remote branch: {remote_branch_name}")
 
         self._checkout(remote_branch_name)
@@ -1283,11 +2908,14 @@ class GitGud:
 
         # Create the master commit
         self._checkout(fork_commit_id)
-        master_commit = GitGud.get_remote_commit(self.repo, self.state.master_branch)
+        master_commit = GitGud.get_remote_commit(
+            self.repo, self.state.master_branch, self.objects
+        )
 
         if master_commit.id in self.state.commits:
             master_commit = self.get_commit(master_commit.id)
         else:
+            master_commit.generation = self._get_generation(master_commit.hash)
             self._insert_remote_commit(master_commit)
 
         self.update(master_commit.id)
@@ -1303,34 +2931,81 @@ class GitGud:
         """Switch the local state to specified commit in order to amend it or
         add new branching commits."""
 
+        self._check_can_update()
+        self._checkout(commit_id)
+        self.state.head = commit_id
+        self.save_state()
+
+    def _check_can_update(self) -> None:
+        """Raise if the checked out commit cannot be switched."""
+
         if self.is_dirty():
             raise ValueError("Cannot update with uncommited local changes.")
 
         if self.state.merge_conflict_state:
             raise ValueError("Cannot update during merge conflict.")
 
-        self._checkout(commit_id)
-        self.state.head = commit_id
-        self.save_state()
-
+    @transactional
     def rebase_continue(self) -> None:
         """Accept the current changes and continue rebase."""
 
         if not self.state.merge_conflict_state:
             raise ValueError("No rebase in progress")
+        self._record_resolutions()
         for file in self.state.merge_conflict_state.files:
             self.repo.git.add(file)
 
         logging.info("Continue rebase of %s", self.state.merge_conflict_state)
 
-        with modified_environ(GIT_EDITOR="true"):
-            self.repo.git.rebase("--continue")
-
         incoming = self.state.merge_conflict_state.incoming
         current = self.state.merge_conflict_state.current
         self.state.merge_conflict_state = None
+
+        self.view.invalidate()
+        try:
+            with modified_environ(GIT_EDITOR="true"):
+                self.repo.git.rebase("--continue")
+        except GitCommandError as e:
+            # A later git commit of the same branch stopped on another conflict.
+            self.handle_merge_conflict(self.get_commit(current), self.get_commit(incoming), e)
+            return
+
         self.continue_evolve(incoming, current)
 
+    def _invalidate_caches(self) -> None:
+        """Drop any data derived from the commit graph."""
+        self._root_index = None
+
+    def _link(self, parent: GudCommit, child: GudCommit, first: bool = False) -> None:
+        """Make `parent` the parent of `child`.
+
+        The children lists and parent ids are the two sides of the commit graph
+        index, all changes to the graph go through this and _unlink() so they
+        stay in sync."""
+
+        if child.parent_id != parent.id or child.id not in parent.children:
+            self._unlink(child)
+            if first:
+                parent.children.insert(0, child.id)
+            else:
+                parent.children.append(child.id)
+
+        child.parent_id = parent.id
+        child.parent_hash = parent.hash
+        self._invalidate_caches()
+
+    def _unlink(self, child: GudCommit) -> None:
+        """Detach a commit from its parent."""
+
+        if child.parent_id in self.state.commits:
+            parent = self.get_commit(child.parent_id)
+            if child.id in parent.children:
+                parent.children.remove(child.id)
+
+        child.parent_id = None
+        child.parent_hash = None
+        self._invalidate_caches()
+
     def get_commit(self, id: str) -> GudCommit:
         if id not in self.state.commits:
             raise ValueError(f"Commit not found: {id}")
@@ -1343,10 +3018,7 @@ class GitGud:
         In normal state, there is a single root. This exists just for debug
         purposes and allow the user to recover when things go wrong."""
 
-        roots_ids: Set[str] = set()
-        for commit_id in self.state.commits:
-            roots_ids.add(self._find_root(self.get_commit(commit_id)).id)
-
+        roots_ids = dict.fromkeys(self.get_root_index().values())
         return [self.get_commit(commit_id) for commit_id in roots_ids]
 
     def print_status(self, full: bool = False) -> None:
@@ -1415,7 +3087,24 @@ class GitGud:
         """Return a tree representation of the local gitgud state for printing."""
 
         commit = commit or self.root()
-        color = "green" if commit == self.head() else "magenta"
+        root_branch = None
+        parents: Dict[str, Tree] = {}
+        for c in self.iter_commits(commit.id):
+            line = self._get_tree_line(c, full)
+            if c.id in parents:
+                branch = parents[c.id].add(line)
+            else:
+                branch = tree.add(line) if tree else Tree(line)
+                root_branch = branch
+            for child_id in c.children:
+                parents[child_id] = branch
+
+        assert root_branch is not None
+        return root_branch
+
+    def _get_tree_line(self, commit: GudCommit, full: bool) -> str:
+        is_head = commit.id == self.state.head
+        color = "green" if is_head else "magenta"
 
         needs_evolve = ""
         if commit.needs_evolve and not self.state.merge_conflict_state:
@@ -1452,7 +3141,7 @@ class GitGud:
             url = self.state.repo_metadata.github.get_pull_request_url(commit.pull_request.id)
             url = f"[bold]{url}[/bold]"
 
-        if commit == self.head():
+        if is_head:
             name_tags.append("Current")
 
         name_annotations = ""
@@ -1470,51 +3159,68 @@ class GitGud:
         line += f"{url} : {date}{commit.get_oneliner()}"
 
         if full:
-            for snapshot in commit.snapshots:
+            for snapshot in self.get_snapshots(commit.id):
                 vertical = "│" if commit.children else " "
                 line += f"\n{vertical} [grey37]{snapshot.hash} : {snapshot.description}[/grey37]"
 
-        if not tree:
-            branch = Tree(line)
-        else:
-            branch = tree.add(line)
-
-        for child_id in commit.children:
-            self.get_tree(self.get_commit(child_id), branch, full=full)
-
-        return branch
+        return line
 
     def is_dirty(self) -> bool:
-        return self.get_dirty_state() != DirtyState()
+        return self.view.is_dirty()
 
     def get_dirty_state(self) -> DirtyState:
-        state = DirtyState()
-        for item in self.repo.index.diff(None):
-            state.modified_files.append(item.a_path)
+        return self.view.get_dirty_state()
 
-        for untracked in self.repo.untracked_files:
-            state.untracked_files.append(untracked)
+    def get_root_index(self) -> Dict[str, str]:
+        """Returns a mapping from every commit id to the id of its root.
 
-        return state
+        Computed in a single iterative pass, every walk stops at the first
+        commit whose root is already known. The result is cached until the
+        commit graph changes."""
 
-    def _find_root(self, commit: GudCommit) -> GudCommit:
-        if commit.parent_id is None:
-            return commit
+        if self._root_index is not None:
+            return self._root_index
 
-        try:
-            parent = self.get_commit(commit.parent_id)
-            return self._find_root(parent)
-        except ValueError:
-            # Error will be captured in one of the bad states. We consider a
-            # commit whose parent does not exist to be a root.
-            return commit
+        index: Dict[str, str] = {}
+        for commit_id in self.state.commits:
+            path: List[str] = []
+            on_path: Set[str] = set()
+            current = commit_id
+            while current not in index:
+                path.append(current)
+                on_path.add(current)
+                parent_id = self.get_commit(current).parent_id
+                # A commit whose parent does not exist is considered a root, the
+                # error will be captured in one of the bad states. Same for cycles.
+                if parent_id is None or parent_id not in self.state.commits or parent_id in on_path:
+                    index[current] = current
+                    break
+                current = parent_id
+
+            root_id = index[current]
+            for path_id in path:
+                index[path_id] = root_id
+
+        self._root_index = index
+        return index
+
+    def _same_tree(self, ref_1: str, ref_2: str) -> bool:
+        """Returns True if both refs point to commits with the same tree."""
+
+        if ref_1 in self.refs.pending or ref_2 in self.refs.pending:
+            return self._read_branch(ref_1).tree == self._read_branch(ref_2).tree
+
+        refs = self.view.get_refs()
+        if ref_1 in refs and ref_2 in refs:
+            return refs[ref_1].tree == refs[ref_2].tree
+        return not self.repo.git.diff(ref_1, ref_2)
 
     def get_bad_states(self) -> List[BadGitGudState]:
         """Returns a list of inconstencies found in gitgud state. This should
         always return empty."""
 
         bad_states = []
-        roots: Set[str] = set()
+        roots = set(self.get_root_index().values())
 
         for commit_id in self.state.commits:
             commit = self.get_commit(commit_id)
@@ -1541,12 +3247,11 @@ class GitGud:
                         )
                     )
 
-            # Check 2: All commits must have a single common ancestors, check at the end
-            roots.add(self._find_root(commit).id)
+            # Check 2: All commits must have a single common ancestors, checked
+            # at the end using the root index.
 
             if not self.is_dirty() and commit.history_branch:
-                diff = self.repo.git.diff(commit.id, commit.history_branch)
-                if diff:
+                if not self._same_tree(commit.id, commit.history_branch):
                     bad_states.append(
                         # Check 3: On a clean state, history and main branch are in equal state
                         BadGitGudState(
@@ -1557,6 +3262,23 @@ class GitGud:
                         )
                     )
 
+        for commit_id in self.state.commits:
+            commit = self.get_commit(commit_id)
+            for child_id in commit.children:
+                if child_id not in self.state.commits:
+                    continue
+                child = self.get_commit(child_id)
+                if child.parent_id != commit.id:
+                    # Check 1b: The reverse index must agree with parent references
+                    bad_states.append(
+                        BadGitGudState(
+                            message=(
+                                f"Parent/child mismatch: {commit.id} has child "
+                                f"{child.id}, whose parent is {child.parent_id}."
+                            )
+                        )
+                    )
+
         if len(roots) > 1:
             bad_states.append(
                 BadGitGudState(message=f"Multiple roots found: {', '.join(sorted(roots))}")
@@ -5,7 +5,7 @@ from git import Repo
 from rich import inspect, print
 import click
 
-from salsa.gg.gg import GitGud
+from salsa.gg.gg import ConflictPolicy, GitGud
 
 
 @click.group()
@@ -34,9 +34,14 @@ def upload(all_: bool) -> None:
 
 @click.command()
 @click.option("--all/--no-all", "all_", default=False, is_flag=True)
-def sync(all_: bool) -> None:
+@click.option(
+    "--conflicts",
+    type=click.Choice([policy.value for policy in ConflictPolicy]),
+    default=ConflictPolicy.STOP.value,
+)
+def sync(all_: bool, conflicts: str) -> None:
     gg = GitGud.for_working_dir(os.getcwd())
-    gg.sync(all=all_)
+    gg.sync(all=all_, conflicts=ConflictPolicy(conflicts))
     gg.print_status()
 
 
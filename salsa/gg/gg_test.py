@@ -1,33 +1,52 @@
-from contextlib import contextmanager
+from contextlib import contextmanager, redirect_stdout
+import io
 import inspect
+import json
 import logging
 import os
 import shutil
+import sys
 import unittest
+from unittest import mock
 from typing import Dict, Iterator, List, Any, Tuple, Optional
 
 import dataclasses
 
-from git import Repo
+from git import GitCommandError, Repo
 
 from salsa.gg.gg import (
     BadGitGudStateError,
     CommitAlreadyMerged,
     ConfigNotFoundError,
+    ConflictPolicy,
+    DirtyState,
+    EvolveOperation,
     GitGud,
     GitGudConfig,
     GitHubRepoMetadata,
     GudCommit,
     HostedRepo,
     InvalidOperationForRemote,
+    LazyCommits,
+    OperationType,
+    PendingOperation,
+    SqliteStateStore,
     GudPullRequest,
     GlobalConfig,
+    StateBackend,
+    StateJournal,
+    TraversalOrder,
     get_branch_name,
+    get_changed_submodules,
+    read_records,
 )
 from salsa.util.subsets import subset_diff
 
 REPO_DIR_NAME = "repo_dir"
 global_config = GlobalConfig(configs_root="/tmp/gg_testing/configs")
+sqlite_global_config = GlobalConfig(
+    configs_root="/tmp/gg_testing/configs", state_backend=StateBackend.SQLITE
+)
 
 
 def append(filename: str, contents: str) -> None:
@@ -103,6 +122,19 @@ class TestBranchName(unittest.TestCase):
         self.assertRegex(get_branch_name("branch"), r"^branch_[0-9a-f]{5}$")
 
 
+class TestGitGudModel(unittest.TestCase):
+    def test_hash_matches_equality(self) -> None:
+        c1 = GudCommit(id="c1", hash="abc", description="commit", uploaded=False)
+        c2 = GudCommit(id="c1", hash="abc", description="commit", uploaded=False)
+        self.assertEqual(c1, c2)
+        self.assertEqual(hash(c1), hash(c2))
+        self.assertEqual(1, len({c1, c2}))
+
+        c2.children.append("c2")
+        self.assertNotEqual(c1, c2)
+        self.assertEqual(2, len({c1, c2}))
+
+
 class TestGithubRepoMetadata(unittest.TestCase):
     def test_from_github_url_clone(self) -> None:
         github_repo = GitHubRepoMetadata.from_github_url("https://github.com/juanique/monorepo.git")
@@ -163,6 +195,10 @@ class TestGitGud(unittest.TestCase):
     def assertFileContents(self, filename: str, contents: str) -> None:
         self.assertEqual(contents, "".join(get_file_contents(filename)))
 
+    def get_head_reflog(self, repo: Repo) -> List[str]:
+        """Returns the messages of the HEAD reflog, oldest first."""
+        return repo.git.reflog("--format=%gs").splitlines()[::-1]
+
     def assertFileDoesNotExist(self, filename: str) -> None:
         self.assertFalse(os.path.exists(filename))
 
@@ -270,6 +306,29 @@ class TestGitGudChecks(TestGitGudWithRemote):
         self.gg.print_status()
         self.assertIn("Parent/child mismatch", str(cm.exception))
 
+    def test_child_parent_mismatch(self) -> None:
+        """Check state function raises if a child listed by a commit points elsewhere."""
+
+        root = self.gg.root()
+        filename_1 = self.make_test_filename()
+        append(filename_1, "testing1")
+        c1 = self.gg.commit("Local change")
+        self.gg.update(root.id)
+
+        append(filename_1, "testing2")
+        c2 = self.gg.commit("Local change 2")
+
+        with self.gg_instance() as gg:
+            gg.get_commit(c1.id).children.append(c2.id)
+
+        with self.assertRaises(BadGitGudStateError) as cm:
+            self.gg.check_state()
+
+        self.assertEqual(
+            f"Parent/child mismatch: {c1.id} has child {c2.id}, whose parent is {root.id}.",
+            str(cm.exception),
+        )
+
     def test_multiple_roots(self) -> None:
         """Check state function raises if all commits don't have a single common
         root ancestors."""
@@ -335,6 +394,20 @@ class TestGitGudWithRemoteAndSubmodules(TestGitGudWithRemote):
         )
         self.assertEqual(["contents-from-submodule\n"], get_file_contents(local_filename))
 
+    def test_changed_submodules(self) -> None:
+        """Only commits that move a gitlink report changed submodules."""
+
+        root = self.gg.head()
+        self.gg.repo.git.submodule("add", self.submodule_repo_path, "./a-submodule")
+        c1 = self.gg.commit("Added submodule.")
+        append(self.make_test_filename(), "testing1")
+        c2 = self.gg.commit("No submodule changes.")
+
+        repo = self.gg.repo
+        self.assertEqual(["a-submodule"], get_changed_submodules(repo, root.hash, c1.hash))
+        self.assertEqual([], get_changed_submodules(repo, c1.hash, c2.hash))
+        self.assertEqual([], get_changed_submodules(repo, c1.hash, root.hash))
+
     def test_sync_submodule_in_remote(self) -> None:
         """Can pull submodules that were added in remote."""
 
@@ -492,6 +565,72 @@ class TestGitGudWithRemoteNoSubmodules(TestGitGudWithRemote):
         state = gg.get_summary()
         self.assertEqual(state.commit_tree.description, "Initial commit")
 
+    def test_ancestry_without_checkout(self) -> None:
+        """Remote commits are ordered without touching the working tree."""
+
+        root = self.gg.root()
+        append(self.remote_filename, "more-contents-from-remote")
+        self.remote_repo.git.commit("-a", "-m", "Added more remote content")
+        new_master = self.gg.sync()
+
+        filename_1 = self.make_test_filename()
+        append(filename_1, "testing1")
+        c1 = self.gg.commit("Local change")
+
+        gg = self.gg
+        reflog = self.get_head_reflog(gg.repo)
+        self.assertTrue(gg.comes_before(root, new_master))
+        self.assertFalse(gg.comes_before(new_master, root))
+        self.assertFalse(gg.comes_before(root, root))
+        self.assertEqual(new_master.hash, gg.ancestry.newest([new_master.hash, root.hash]))
+        self.assertEqual(reflog, self.get_head_reflog(gg.repo))
+        self.assertEqual(c1.id, gg.repo.active_branch.name)
+
+    def test_remote_commits_ordered_by_generation(self) -> None:
+        """Remote commits carry a generation number that orders them without git."""
+
+        self.assertEqual(0, self.gg.root().generation)
+        for i in range(2):
+            append(self.remote_filename, f"more-contents-from-remote-{i}")
+            self.remote_repo.git.commit("-a", "-m", f"Added more remote content {i}")
+
+        new_master = self.gg.sync()
+        self.assertEqual(2, new_master.generation)
+
+        gg = self.gg
+        new_master = gg.get_commit(new_master.id)
+
+        # The commits share a hash, git can't tell which comes first.
+        def remote_commit(commit_id: str, generation: int) -> GudCommit:
+            return GudCommit(
+                id=commit_id,
+                hash=new_master.hash,
+                description=commit_id,
+                remote=True,
+                uploaded=True,
+                generation=generation,
+            )
+
+        latest = remote_commit("master@latest", 4)
+        gg.state.commits[latest.id] = latest
+        gg._link(new_master, latest)
+        gg._insert_remote_commit(remote_commit("master@middle", 3))
+
+        self.assertEqual(["master@middle"], new_master.children)
+        self.assertEqual("master@middle", gg.get_commit("master@latest").parent_id)
+
+    def test_generation_seeded_for_old_states(self) -> None:
+        """States without generations get one on the next pulled commit."""
+
+        gg = self.gg
+        gg.root().generation = None
+        gg.save_state()
+
+        append(self.remote_filename, "more-contents-from-remote")
+        self.remote_repo.git.commit("-a", "-m", "Added more remote content")
+        new_master = self.gg.sync()
+        self.assertEqual(2, new_master.generation)
+
     def test_amend_remote_fails(self) -> None:
         filename_1 = self.make_test_filename()
         append(filename_1, "testing1")
@@ -667,6 +806,42 @@ class TestGitGudWithRemoteNoSubmodules(TestGitGudWithRemote):
         }
         self.assertSubset(expected_summary, self.gg.get_summary().dict())
 
+    def test_sync_all_skip_conflicts(self) -> None:
+        """Stacks predicted to conflict with the remote are reported up front,
+        and can be left alone while the other stacks are synced."""
+
+        append(self.remote_filename, "more-contents-from-remote")
+        self.remote_repo.git.add("-A")
+        self.remote_repo.git.commit("-a", "-m", "Added more remote content")
+
+        root = self.gg.head()
+        append(self.make_test_filename(), "something")
+        c1 = self.gg.commit("something")
+
+        self.gg.update(root.id)
+        local_filename = os.path.join(self.local_repo_path, os.path.basename(self.remote_filename))
+        append(local_filename, "more-contents-from-local")
+        c2 = self.gg.commit("added local content")
+        append(self.make_test_filename(), "child")
+        c3 = self.gg.commit("child of conflict")
+
+        gg = self.gg
+        gg.repo.git.fetch("origin")
+        conflicts = gg.predict_conflicts(c2.id, gg.repo.git.rev_parse("origin/master"))
+        self.assertEqual([c2.id], [conflict.commit_id for conflict in conflicts])
+        self.assertEqual([os.path.basename(self.remote_filename)], conflicts[0].files)
+
+        gg.update(root.id)
+        gg.sync(all=True, conflicts=ConflictPolicy.SKIP)
+        self.assertIsNone(gg.state.merge_conflict_state)
+
+        c1 = gg.get_commit(c1.id)
+        assert c1.parent_id is not None
+        self.assertEqual("Added more remote content", gg.get_commit(c1.parent_id).description)
+        self.assertEqual(c2.id, gg.get_commit(c3.id).parent_id)
+        self.assertEqual(c2.hash, gg.get_commit(c2.id).hash)
+        self.assertEqual([], gg.get_bad_states())
+
     def test_sync_dirty(self) -> None:
         """Cannot sync on a dirty state."""
         # Remote change
@@ -731,6 +906,24 @@ class TestGitGudWithRemoteNoSubmodules(TestGitGudWithRemote):
         }
         self.assertSubset(expected, self.gg.get_summary().dict())
 
+    def test_plan_sync(self) -> None:
+        """The sync plan lists every local stack with its commits."""
+
+        root = self.gg.head()
+        append(self.make_test_filename(), "testing1")
+        c1 = self.gg.commit("local-1")
+        append(self.make_test_filename(), "testing2")
+        c2 = self.gg.commit("local-2")
+
+        self.gg.update(root.id)
+        append(self.make_test_filename(), "testing3")
+        c3 = self.gg.commit("local-3")
+
+        plan = self.gg.plan_sync()
+        stacks = sorted([[c1.id, c2.id], [c3.id]], key=min)
+        self.assertEqual(stacks, [stack.commit_ids for stack in plan.stacks])
+        self.assertEqual([s[0] for s in stacks], [stack.root_id for stack in plan.stacks])
+
     def test_sync_remote(self) -> None:
         """Remote changes can be pulled locally by calling GitGud::sync().
 
@@ -1422,11 +1615,11 @@ class TestGitGudLocalNoChecks(TestGitGudLocalOnly):
         self.gg.amend("Add file again")
 
         # History snapshot 1 is when file was deleted
-        self.gg.restore_snapshot(self.gg.head().snapshots[1].hash)
+        self.gg.restore_snapshot(self.gg.get_snapshots(self.gg.head().id)[1].hash)
         self.assertFileDoesNotExist(filename_1)
 
         # History snapshot 2 is when file was created again
-        self.gg.restore_snapshot(self.gg.head().snapshots[2].hash)
+        self.gg.restore_snapshot(self.gg.get_snapshots(self.gg.head().id)[2].hash)
         self.assertFileContents(filename_1, "testing1\n")
 
     def test_amend_evolve_single_line(self) -> None:
@@ -1579,6 +1772,61 @@ class TestGitGudLocalNoChecks(TestGitGudLocalOnly):
         self.assertEqual([], dirty_state.untracked_files)
         self.assertEqual([relative_filename], dirty_state.modified_files)
 
+    def test_dirty_state_from_status(self) -> None:
+        """The dirty state handles renames and unusual file names."""
+
+        filename = self.make_test_filename()
+        append(filename, "testing1")
+        self.gg.commit("My first commit")
+
+        gg = self.gg
+        gg.repo.git.mv(filename, os.path.join(self.local_repo_path, "renamed file.txt"))
+        append(os.path.join(self.local_repo_path, "new file.txt"), "testing2")
+        self.assertEqual(["new file.txt"], gg.get_dirty_state().untracked_files)
+        self.assertEqual([], gg.get_dirty_state().modified_files)
+
+        append(os.path.join(self.local_repo_path, "renamed file.txt"), "testing3")
+        gg = self.gg
+        self.assertTrue(gg.is_dirty())
+        self.assertEqual(["renamed file.txt"], gg.get_dirty_state().modified_files)
+
+    def test_dirty_state_git_failure(self) -> None:
+        """A failing git status is an error, not a clean tree."""
+
+        append(self.make_test_filename(), "testing1")
+        self.gg.commit("My first commit")
+
+        gg = self.gg
+        index_filename = os.path.join(self.local_repo_path, ".git", "index")
+        with open(index_filename, "rb") as f:
+            index = f.read()
+        with open(index_filename, "wb") as f:
+            f.write(b"corrupt")
+
+        gg.view.invalidate()
+        try:
+            with self.assertRaises(GitCommandError):
+                gg.is_dirty()
+        finally:
+            with open(index_filename, "wb") as f:
+                f.write(index)
+
+    def test_dirty_state_cached(self) -> None:
+        """The dirty state is computed once and refreshed after gg changes the repo."""
+
+        filename = self.make_test_filename()
+        append(filename, "testing1")
+
+        gg = self.gg
+        dirty_state = gg.get_dirty_state()
+        self.assertIs(dirty_state, gg.get_dirty_state())
+        self.assertTrue(gg.is_dirty())
+
+        gg.commit("My first commit")
+        self.assertEqual(DirtyState(), gg.get_dirty_state())
+        self.assertIn(gg.head().id, gg.view.get_refs())
+        self.assertEqual(gg.head().hash, gg.view.get_head())
+
     def test_amend_snapshot(self) -> None:
         """Amending commits creates snapshots.
 
@@ -1596,43 +1844,43 @@ class TestGitGudLocalNoChecks(TestGitGudLocalOnly):
         # First commit is snapshot 0
         append(filename, "testing1")
         self.gg.commit("My first commit")
-        self.assertEqual(len(self.gg.head().snapshots), 1)
+        self.assertEqual(self.gg.head().snapshot_count, 1)
 
         # Amend is snapshot 1
         append(filename, "testing2")
         self.gg.amend()
-        self.assertEqual(len(self.gg.head().snapshots), 2)
+        self.assertEqual(self.gg.head().snapshot_count, 2)
 
         # Seconda amend is snapshot 2
         append(filename, "testing3")
         self.gg.amend()
-        self.assertEqual(len(self.gg.head().snapshots), 3)
+        self.assertEqual(self.gg.head().snapshot_count, 3)
 
         self.gg.print_status(full=True)
 
         # We restore to snapshot 1
-        self.gg.restore_snapshot(self.gg.head().snapshots[1].hash)
+        self.gg.restore_snapshot(self.gg.get_snapshots(self.gg.head().id)[1].hash)
 
         expected = "testing1\ntesting2\n"
         self.assertEqual(expected, "".join(get_file_contents(filename)))
 
         # We restore to snapshot 0
-        self.gg.restore_snapshot(self.gg.head().snapshots[0].hash)
+        self.gg.restore_snapshot(self.gg.get_snapshots(self.gg.head().id)[0].hash)
 
         expected = "testing1\n"
         self.assertEqual(expected, "".join(get_file_contents(filename)))
 
         # Each restore creates a new snapshot
-        self.assertEqual(len(self.gg.head().snapshots), 5)
+        self.assertEqual(self.gg.head().snapshot_count, 5)
 
         # We restore to snapshot 2
-        self.gg.restore_snapshot(self.gg.head().snapshots[2].hash)
+        self.gg.restore_snapshot(self.gg.get_snapshots(self.gg.head().id)[2].hash)
 
         expected = "testing1\ntesting2\ntesting3\n"
         self.assertEqual(expected, "".join(get_file_contents(filename)))
 
         # Each restore creates a new snapshot
-        self.assertEqual(len(self.gg.head().snapshots), 6)
+        self.assertEqual(self.gg.head().snapshot_count, 6)
 
     def test_amend_multiple_children(self) -> None:
         """Can update old commits and propagate changes on multiple children."""
@@ -1725,6 +1973,107 @@ class TestGitGudLocalNoChecks(TestGitGudLocalOnly):
         self.assertFileContents(filename_2, "commit2\n")
         self.assertFileDoesNotExist(filename_1)
 
+    def test_rebase_stack(self) -> None:
+        """When the first commit can't be rebased in memory because its branch
+        has several git commits, the linear stack is rebased with a single git
+        rebase."""
+
+        filename_1 = self.make_test_filename()
+        append(filename_1, "commit1")
+        c1 = self.gg.commit("commit1")
+        # A plain git commit followed by an amend leaves two git commits in c1.
+        append(filename_1, "commit1.1")
+        gg = self.gg
+        gg.repo.git.commit("-a", "-m", "plain git commit")
+        gg.amend()
+
+        filename_2 = self.make_test_filename()
+        append(filename_2, "commit2")
+        c2 = self.gg.commit("commit2")
+
+        self.gg.update("master")
+        filename_3 = self.make_test_filename()
+        append(filename_3, "commit3")
+        c3 = self.gg.commit("commit3")
+        c2_history = self.gg.repo.heads[c2.history_branch].commit.hexsha
+
+        gg = self.gg
+        reflog_size = len(self.get_head_reflog(gg.repo))
+        gg.rebase(source_id=c1.id, dest_id=c3.id)
+        reflog = self.get_head_reflog(gg.repo)[reflog_size:]
+        self.assertEqual(1, len([entry for entry in reflog if entry.startswith("rebase (start)")]))
+        self.assertEqual(
+            f"rebase (finish): refs/heads/{c2.id} onto {c3.hash}",
+            gg.repo.git.reflog("show", "-1", "--format=%gs", c2.id),
+        )
+        self.assertEqual([], gg.state.pending_operations)
+
+        c1, c2 = gg.get_commit(c1.id), gg.get_commit(c2.id)
+        self.assertEqual(c1.id, gg.head().id)
+        self.assertEqual(c3.hash, gg.repo.commit(c1.hash).parents[0].parents[0].hexsha)
+        self.assertEqual([c1.hash], [p.hexsha for p in gg.repo.commit(c2.hash).parents])
+
+        c2_history_merge = gg.repo.heads[c2.history_branch].commit
+        self.assertEqual(c2_history, c2_history_merge.parents[0].hexsha)
+        self.assertEqual(gg.repo.commit(c2.hash).tree, c2_history_merge.tree)
+
+        self.gg.update(c2.id)
+        self.assertFileContents(filename_1, "commit1\ncommit1.1\n")
+        self.assertFileContents(filename_2, "commit2\n")
+        self.assertFileContents(filename_3, "commit3\n")
+
+    def test_rebase_reports_expected_conflicts(self) -> None:
+        """Conflicts are predicted for every git commit of a branch and printed
+        before the rebase starts."""
+
+        filename = self.make_test_filename()
+        append(filename, "commit1")
+        c1 = self.gg.commit("commit1")
+        # The conflicting change is in the first of two git commits.
+        gg = self.gg
+        append(self.make_test_filename(), "commit1.1")
+        gg.repo.git.add("-A")
+        gg.repo.git.commit("-m", "plain git commit")
+        gg.amend()
+
+        self.gg.update("master")
+        append(filename, "commit3")
+        c3 = self.gg.commit("commit3")
+
+        gg = self.gg
+        conflicts = gg.predict_conflicts(c1.id, c3.hash)
+        self.assertEqual([c1.id], [conflict.commit_id for conflict in conflicts])
+        self.assertEqual([os.path.basename(filename)], conflicts[0].files)
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            gg.rebase(source_id=c1.id, dest_id=c3.id)
+        self.assertIn(f"{c1.id}: {os.path.basename(filename)}", output.getvalue())
+        self.assertIsNotNone(gg.state.merge_conflict_state)
+
+    def test_rebase_conflict_skips_stack_rebase(self) -> None:
+        """A conflict found in memory goes straight to the per-commit rebase,
+        without trying the stack rebase first."""
+
+        filename = self.make_test_filename()
+        append(filename, "commit1")
+        c1 = self.gg.commit("commit1")
+        append(self.make_test_filename(), "commit2")
+        self.gg.commit("commit2")
+
+        self.gg.update("master")
+        append(filename, "commit3")
+        c3 = self.gg.commit("commit3")
+
+        gg = self.gg
+        reflog_size = len(self.get_head_reflog(gg.repo))
+        gg.rebase(source_id=c1.id, dest_id=c3.id)
+        reflog = self.get_head_reflog(gg.repo)[reflog_size:]
+        rebases = [entry for entry in reflog if entry.startswith("rebase")]
+        self.assertEqual(1, len(rebases))
+        self.assertTrue(rebases[0].startswith("rebase (start)"))
+        self.assertIsNotNone(gg.state.merge_conflict_state)
+
     def test_rebase_auto_evolve(self) -> None:
         """
         We start with:
@@ -1775,6 +2124,566 @@ class TestGitGudLocalNoChecks(TestGitGudLocalOnly):
         self.assertFileContents(filename_3, "commit3\n")
         self.assertFileContents(filename_4, "commit4\n")
 
+    def test_save_state_appends_to_journal(self) -> None:
+        """Saving state appends the changes to a journal instead of rewriting
+        the whole state file."""
+
+        state_filename = GitGud.state_filename(self.local_repo_path, global_config)
+        checkpoint = get_file_contents(state_filename)
+
+        filename = self.make_test_filename()
+        append(filename, "testing1")
+        c1 = self.gg.commit("My first commit")
+        append(filename, "testing2")
+        self.gg.amend()
+
+        self.assertEqual(checkpoint, get_file_contents(state_filename))
+        state_store = self.gg._state_store
+        assert isinstance(state_store, StateJournal)
+        journal_filename = state_store.journal_filename
+        self.assertEqual(2, len(get_file_contents(journal_filename)))
+        self.assertEqual(self.gg.get_snapshots(c1.id)[1].description, "Snapshot #1")
+
+    def test_interrupted_checkpoint_ignores_old_journal(self) -> None:
+        """If a checkpoint is interrupted before the old journal is removed,
+        the journal is not replayed on top of the newer checkpoint."""
+
+        append(self.make_test_filename(), "testing1")
+        c1 = self.gg.commit("My first commit")
+        append(self.make_test_filename(), "testing2")
+        c2 = self.gg.commit("My second commit")
+        self.gg.update(c1.id)
+
+        gg = self.gg
+        state_store = gg._state_store
+        assert isinstance(state_store, StateJournal)
+        journal_filename = state_store.journal_filename
+        journal = get_file_contents(journal_filename)
+        gg.state.head = c2.id
+        state_store.checkpoint(gg.state)
+        # Put back the old journal, as if the checkpoint stopped before removing it.
+        self.assertFileDoesNotExist(journal_filename)
+        with open(journal_filename, "w", encoding="utf-8") as f:
+            f.write("".join(journal))
+
+        self.assertEqual(c2.id, self.gg.head().id)
+
+    def test_journal_recovers_from_torn_record(self) -> None:
+        """A record torn by an interrupted write is dropped, and the changes
+        saved after it are not lost."""
+
+        state_filename = GitGud.state_filename(self.local_repo_path, global_config)
+        append(self.make_test_filename(), "testing1")
+        c1 = self.gg.commit("My first commit")
+
+        state_store = self.gg._state_store
+        assert isinstance(state_store, StateJournal)
+        journal_filename = state_store.journal_filename
+        for filename in (journal_filename, f"{state_filename}.snapshots"):
+            with open(filename, "a", encoding="utf-8") as f:
+                f.write('{"fields": {"head": ')
+
+        append(self.make_test_filename(), "testing2")
+        c2 = self.gg.commit("My second commit")
+
+        gg = self.gg
+        self.assertEqual(c2.id, gg.head().id)
+        self.assertEqual([c2.id], gg.get_commit(c1.id).children)
+        self.assertEqual(1, len(gg.get_snapshots(c2.id)))
+
+    def test_snapshot_archive_read_once(self) -> None:
+        """Printing the snapshots of every commit reads the archive once, and
+        checkpoints drop the snapshots of removed commits."""
+
+        state_filename = GitGud.state_filename(self.local_repo_path, global_config)
+        filename = self.make_test_filename()
+        for i in range(3):
+            append(filename, f"testing{i}")
+            self.gg.commit(f"Commit {i}")
+            append(filename, f"testing{i}.1")
+            self.gg.amend()
+
+        gg = self.gg
+        with mock.patch("salsa.gg.gg.read_records", wraps=read_records) as read:
+            gg.print_status(full=True)
+        self.assertEqual(1, read.call_count)
+
+        dropped = gg.head()
+        gg.drop_commit(dropped.id)
+        gg._state_store.checkpoint(gg.state)
+        records = [json.loads(line) for line in get_file_contents(f"{state_filename}.snapshots")]
+        self.assertEqual(4, len(records))
+        self.assertNotIn(dropped.id, [record["commit_id"] for record in records])
+
+    def test_evolve_defers_state_writes(self) -> None:
+        """Evolving a stack in memory writes the state a few times, not once
+        per evolved commit."""
+
+        filename = self.make_test_filename()
+        append(filename, "testing1")
+        c1 = self.gg.commit("My first commit")
+        for i in range(10):
+            append(self.make_test_filename(), f"child{i}")
+            self.gg.commit(f"Child {i}")
+
+        self.gg.update(c1.id)
+        append(filename, "testing2")
+        self.gg.amend()
+
+        gg = self.gg
+        state_store = gg._state_store
+        assert isinstance(state_store, StateJournal)
+        journal_records = len(get_file_contents(state_store.journal_filename))
+        gg.evolve()
+
+        writes = len(get_file_contents(state_store.journal_filename)) - journal_records
+        self.assertLessEqual(writes, 2)
+        self.assertFalse(any(c.needs_evolve for c in self.gg.state.commits.values()))
+
+    def test_snapshot_without_checkout(self) -> None:
+        """Amending records the snapshot in the history branch without switching
+        branches."""
+
+        filename = self.make_test_filename()
+        append(filename, "testing1")
+        c1 = self.gg.commit("My first commit")
+
+        append(filename, "testing2")
+        gg = self.gg
+        reflog_size = len(self.get_head_reflog(gg.repo))
+        gg.amend("Second version")
+        reflog = self.get_head_reflog(gg.repo)[reflog_size:]
+        self.assertEqual([], [entry for entry in reflog if entry.startswith("checkout:")])
+
+        head = gg.head()
+        snapshot = head.latest_snapshot
+        assert snapshot is not None and c1.history_branch is not None
+        self.assertEqual(c1.id, gg.repo.active_branch.name)
+        self.assertEqual(2, head.snapshot_count)
+        self.assertEqual(gg.repo.heads[c1.history_branch].commit.hexsha, snapshot.hash)
+        self.assertEqual(gg.repo.commit(head.hash).tree, gg.repo.commit(snapshot.hash).tree)
+        self.assertFalse(gg.is_dirty())
+
+    def test_evolve_in_memory(self) -> None:
+        """Evolving without conflicts rewrites commits from the object database,
+        keeping their original author."""
+
+        filename = self.make_test_filename()
+        append(filename, "testing1")
+        c1 = self.gg.commit("My first commit")
+        append(self.make_test_filename(), "child")
+        c2 = self.gg.commit("Child")
+        author_date = self.gg.repo.commit(c2.hash).authored_datetime
+
+        self.gg.update(c1.id)
+        append(filename, "testing2")
+        self.gg.amend()
+
+        gg = self.gg
+        reflog_size = len(self.get_head_reflog(gg.repo))
+        gg.evolve()
+        self.assertEqual(
+            [f"checkout: moving from {c1.id} to {c2.id}"],
+            self.get_head_reflog(gg.repo)[reflog_size:],
+        )
+        self.assertIsNone(gg.state.merge_conflict_state)
+
+        c2_git = gg.repo.commit(gg.get_commit(c2.id).hash)
+        self.assertEqual([gg.get_commit(c1.id).hash], [p.hexsha for p in c2_git.parents])
+        self.assertEqual(author_date, c2_git.authored_datetime)
+        self.assertEqual("Child", c2_git.message.strip())
+        self.assertEqual(["testing1\n", "testing2\n"], get_file_contents(filename))
+
+    def test_evolve_nothing_to_evolve_keeps_checkout_in_sync(self) -> None:
+        """Queued evolves that have nothing to do leave the checked out branch
+        and the head of the state pointing to the same commit."""
+
+        append(self.make_test_filename(), "testing1")
+        c1 = self.gg.commit("My first commit")
+        append(self.make_test_filename(), "testing2")
+        c2 = self.gg.commit("My second commit")
+        append(self.make_test_filename(), "testing3")
+        self.gg.commit("My third commit")
+
+        self.gg.update(c1.id)
+        gg = self.gg
+        gg.evolve()
+
+        self.assertEqual(c2.id, gg.head().id)
+        self.assertEqual(c2.id, gg.repo.active_branch.name)
+
+    def test_evolve_dirty(self) -> None:
+        """Cannot evolve with uncommitted changes, and nothing is changed."""
+
+        filename = self.make_test_filename()
+        append(filename, "testing1")
+        c1 = self.gg.commit("My first commit")
+        append(filename, "testing2")
+        c2 = self.gg.commit("My second commit")
+
+        self.gg.update(c1.id)
+        append(self.make_test_filename(), "testing3")
+        self.gg.amend()
+
+        append(filename, "uncommitted")
+        gg = self.gg
+        with self.assertRaises(ValueError) as cm:
+            gg.evolve()
+        self.assertEqual("Cannot update with uncommited local changes.", str(cm.exception))
+
+        gg = self.gg
+        self.assertEqual(c1.id, gg.head().id)
+        self.assertEqual(c1.id, gg.repo.active_branch.name)
+        self.assertEqual(c2.hash, gg.get_commit(c2.id).hash)
+        self.assertEqual(c2.hash, gg.repo.heads[c2.id].commit.hexsha)
+        self.assertEqual([], gg.state.pending_operations)
+
+    def test_evolve_unchanged_tree_skips_rebase(self) -> None:
+        """Amending without changes re-parents the children with a ref update
+        only, without a rebase or a history merge."""
+
+        append(self.make_test_filename(), "testing1")
+        c1 = self.gg.commit("My first commit")
+        append(self.make_test_filename(), "child")
+        c2 = self.gg.commit("Child")
+        assert c2.history_branch is not None
+        c2_history = self.gg.repo.heads[c2.history_branch].commit.hexsha
+
+        self.gg.update(c1.id)
+        self.gg.amend()
+
+        gg = self.gg
+        reflog_size = len(self.get_head_reflog(gg.repo))
+        gg.evolve()
+        self.assertEqual(
+            [f"checkout: moving from {c1.id} to {c2.id}"],
+            self.get_head_reflog(gg.repo)[reflog_size:],
+        )
+        self.assertIsNone(gg.state.merge_conflict_state)
+
+        self.assertEqual(1, len(gg.get_snapshots(c2.id)))
+        c2 = gg.get_commit(c2.id)
+        self.assertFalse(c2.needs_evolve)
+        self.assertEqual(c2.id, gg.head().id)
+        c2_git = gg.repo.commit(c2.hash)
+        self.assertEqual([gg.get_commit(c1.id).hash], [p.hexsha for p in c2_git.parents])
+        self.assertEqual(c2_history, gg.repo.heads[c2.history_branch].commit.hexsha)
+        self.assertEqual([], gg.get_bad_states())
+
+    def test_evolve_reuses_recorded_resolution(self) -> None:
+        """A conflict that was resolved once is resolved the same way when it
+        shows up again, without stopping the evolve."""
+
+        filename = self.make_test_filename()
+        append(filename, "testing1")
+        c1 = self.gg.commit("My first commit")
+        append(filename, "child")
+        c2 = self.gg.commit("Child 1")
+
+        self.gg.update(c1.id)
+        append(filename, "child")
+        c3 = self.gg.commit("Child 2")
+
+        self.gg.update(c1.id)
+        append(filename, "parent")
+        self.gg.amend()
+
+        gg = self.gg
+        gg.evolve()
+        conflict = gg.state.merge_conflict_state
+        assert conflict is not None
+        self.assertEqual([filename], [os.path.join(gg.state.repo_dir, f) for f in conflict.files])
+
+        set_file_contents(filename, "testing1\nparent\nchild")
+        resolved = "".join(get_file_contents(filename))
+        gg.rebase_continue()
+
+        self.assertIsNone(gg.state.merge_conflict_state)
+        c1_hash = gg.get_commit(c1.id).hash
+        for commit_id in (c2.id, c3.id):
+            commit = gg.repo.commit(gg.get_commit(commit_id).hash)
+            self.assertEqual(c1_hash, commit.parents[0].hexsha)
+            blob = commit.tree / os.path.basename(filename)
+            self.assertEqual(resolved, blob.data_stream.read().decode())
+        self.assertEqual([], gg.get_bad_states())
+
+    def test_rebase_continue_second_conflict(self) -> None:
+        """When another git commit of the same branch conflicts after continuing,
+        the new conflict is recorded."""
+
+        filename = self.make_test_filename()
+        append(filename, "line0")
+        c0 = self.gg.commit("Base")
+        append(filename, "one")
+        c1 = self.gg.commit("commit1")
+        gg = self.gg
+        set_file_contents(filename, "line0\nONE")
+        gg.repo.git.commit("-a", "-m", "plain git commit")
+        append(self.make_test_filename(), "amended")
+        gg.amend()
+
+        self.gg.update(c0.id)
+        append(filename, "three")
+        c3 = self.gg.commit("commit3")
+
+        gg = self.gg
+        gg.rebase(source_id=c1.id, dest_id=c3.id)
+        self.assertIsNotNone(gg.state.merge_conflict_state)
+
+        set_file_contents(filename, "line0\nthree\none")
+        gg.rebase_continue()
+        conflict = gg.state.merge_conflict_state
+        assert conflict is not None
+        self.assertEqual((c3.id, c1.id), (conflict.current, conflict.incoming))
+        self.assertIn("<<<<<<<", "".join(get_file_contents(filename)))
+
+        set_file_contents(filename, "line0\nthree\nONE")
+        gg.rebase_continue()
+        self.assertIsNone(gg.state.merge_conflict_state)
+        self.assertEqual(gg.get_commit(c3.id).id, gg.get_commit(c1.id).parent_id)
+        self.assertFileContents(filename, "line0\nthree\nONE\n")
+
+    def test_evolve_stack_checks_out_final_head_only(self) -> None:
+        """Evolving a stack records history merges without switching branches,
+        and only checks out the last evolved commit."""
+
+        filename = self.make_test_filename()
+        append(filename, "testing1")
+        c1 = self.gg.commit("My first commit")
+        for i in range(3):
+            append(self.make_test_filename(), f"child{i}")
+            self.gg.commit(f"Child {i}")
+        last = self.gg.head()
+
+        self.gg.update(c1.id)
+        append(filename, "testing2")
+        self.gg.amend()
+
+        gg = self.gg
+        reflog_size = len(self.get_head_reflog(gg.repo))
+        gg.evolve()
+        self.assertEqual(
+            [f"checkout: moving from {c1.id} to {last.id}"],
+            self.get_head_reflog(gg.repo)[reflog_size:],
+        )
+        self.assertEqual(last.id, gg.repo.active_branch.name)
+        self.assertFalse(gg.is_dirty())
+
+        c2 = gg.get_commit(gg.get_commit(c1.id).children[0])
+        assert c2.history_branch is not None and c1.history_branch is not None
+        history_merge = gg.repo.heads[c2.history_branch].commit
+        self.assertEqual(f"Evolved changes from {c1.id}", history_merge.message.strip())
+        self.assertEqual(gg.repo.commit(c2.hash).tree, history_merge.tree)
+        self.assertEqual(gg.repo.heads[c1.history_branch].commit, history_merge.parents[1])
+
+    def test_ref_transaction(self) -> None:
+        """Ref changes are applied together at the end of a transaction, or not
+        at all."""
+
+        append(self.make_test_filename(), "testing1")
+        c1 = self.gg.commit("My first commit")
+
+        gg = self.gg
+        with gg.transaction():
+            gg.refs.create("new-branch", c1.hash)
+            self.assertEqual(c1.hash, gg.refs.resolve("new-branch"))
+            self.assertNotIn("new-branch", gg.repo.heads)
+        self.assertEqual(c1.hash, gg.repo.heads["new-branch"].commit.hexsha)
+
+        gg.refs.create("other-branch", c1.hash)
+        gg.refs.update("new-branch", c1.hash, gg.root().hash)
+        with self.assertRaises(GitCommandError):
+            gg.flush_refs()
+        self.assertNotIn("other-branch", gg.repo.heads)
+
+    def test_commits_loaded_on_demand(self) -> None:
+        """Stored commits are only validated once they are accessed."""
+
+        append(self.make_test_filename(), "testing1")
+        c1 = self.gg.commit("My first commit")
+        append(self.make_test_filename(), "testing2")
+        self.gg.commit("My second commit")
+
+        state = GitGud.load_state_for_directory(self.local_repo_path, global_config)
+        assert isinstance(state.commits, LazyCommits)
+        self.assertEqual({}, state.commits.loaded())
+
+        self.assertEqual(c1.hash, state.commits[c1.id].hash)
+        self.assertEqual([c1.id], list(state.commits.loaded()))
+
+    def test_root_index_on_deep_stack(self) -> None:
+        """Roots are found without recursion, even for stacks deeper than the
+        interpreter recursion limit."""
+
+        gg = self.gg
+        root = gg.root()
+        parent = root
+        for i in range(sys.getrecursionlimit() + 100):
+            commit = GudCommit(
+                id=f"deep-{i}", hash=root.hash, description=f"Deep {i}", uploaded=True
+            )
+            gg.state.commits[commit.id] = commit
+            gg._link(parent, commit)
+            parent = commit
+
+        self.assertEqual([root.id], [commit.id for commit in gg.get_roots()])
+        self.assertEqual(root.id, gg.get_root_index()[parent.id])
+
+        gg._unlink(gg.get_commit("deep-10"))
+        self.assertEqual("deep-10", gg.get_root_index()[parent.id])
+
+    def test_iter_commits_orders(self) -> None:
+        """Commits can be streamed in pre-order, post-order or BFS, filtered and
+        stopped early."""
+
+        gg = self.gg
+        root = gg.root()
+
+        def add(commit_id: str, parent: GudCommit) -> GudCommit:
+            commit = GudCommit(id=commit_id, hash=root.hash, description=commit_id, uploaded=True)
+            gg.state.commits[commit.id] = commit
+            gg._link(parent, commit)
+            return commit
+
+        a = add("a", root)
+        add("a1", a)
+        add("a2", a)
+        b = add("b", root)
+        add("b1", b)
+
+        def ids(commits: Iterator[GudCommit]) -> List[str]:
+            return [c.id for c in commits]
+
+        self.assertEqual([root.id, "a", "a1", "a2", "b", "b1"], ids(gg.iter_commits()))
+        self.assertEqual(
+            ["a1", "a2", "a", "b1", "b", root.id],
+            ids(gg.iter_commits(order=TraversalOrder.POST_ORDER)),
+        )
+        self.assertEqual(
+            [root.id, "a", "b", "a1", "a2", "b1"], ids(gg.iter_commits(order=TraversalOrder.BFS))
+        )
+        self.assertEqual(["a1", "a2"], ids(gg.iter_commits("a", skip=True)))
+        odd = gg.iter_commits(where=lambda c: c.id.endswith("1"))
+        self.assertEqual(["a1", "b1"], ids(odd))
+
+        commits = gg.iter_commits()
+        self.assertEqual([root.id, "a"], [next(commits).id, next(commits).id])
+
+    def test_object_reader(self) -> None:
+        """Commit objects are read from the cat-file process and cached."""
+
+        append(self.make_test_filename(), "testing1")
+        c1 = self.gg.commit("My first commit\n\nWith a longer description.")
+
+        gg = self.gg
+        git_commit = gg.repo.commit(c1.hash)
+        commit_object = gg.objects.read_commit(c1.hash)
+        self.assertEqual(git_commit.tree.hexsha, commit_object.tree)
+        self.assertEqual([p.hexsha for p in git_commit.parents], commit_object.parents)
+        self.assertEqual(git_commit.message, commit_object.message)
+        self.assertEqual(git_commit.authored_datetime, commit_object.author_date)
+
+        self.assertIs(commit_object, gg.objects.read_commit(c1.hash))
+
+    def test_inline_snapshots_moved_to_archive(self) -> None:
+        """States that still keep snapshots inside each commit have them moved
+        to the snapshot archive."""
+
+        state_filename = GitGud.state_filename(self.local_repo_path, global_config)
+        with open(state_filename, encoding="utf-8") as f:
+            obj = json.load(f)
+
+        root = obj["commits"]["master"]
+        del root["snapshot_count"]
+        del root["latest_snapshot"]
+        root["snapshots"] = [{"hash": root["hash"], "description": "Inline snapshot"}]
+        with open(state_filename, "w", encoding="utf-8") as f:
+            json.dump(obj, f)
+
+        append(self.make_test_filename(), "testing1")
+        self.gg.commit("My first commit")
+
+        self.assertEqual(1, self.gg.get_commit("master").snapshot_count)
+        snapshots = self.gg.get_snapshots("master")
+        self.assertEqual(["Inline snapshot"], [s.description for s in snapshots])
+
+
+class TestGitGudSqliteState(TestGitGudLocalOnly):
+    def setUp(self) -> None:
+        super().setUp()
+
+        db_filename = GitGud.state_filename(self.local_repo_path, global_config) + ".sqlite"
+        if os.path.exists(db_filename):
+            os.remove(db_filename)
+
+    @property
+    def gg(self) -> GitGud:
+        gg = GitGud.for_working_dir(self.local_repo_path, global_config=sqlite_global_config)
+        gg.check_state()
+        return gg
+
+    def test_migrate(self) -> None:
+        """JSON state is migrated on first load, including its snapshot archive."""
+
+        filename = self.make_test_filename()
+        append(filename, "testing1")
+        c1 = GitGud.for_working_dir(self.local_repo_path, global_config=global_config).commit(
+            "My first commit"
+        )
+        append(filename, "testing2")
+        self.gg.amend()
+        append(self.make_test_filename(), "testing3")
+        c2 = self.gg.commit("My second commit")
+
+        c1, c2 = self.reload_all(c1, c2)
+        self.assertEqual(2, len(self.gg.get_snapshots(c1.id)))
+        self.assertEqual([c2.id], c1.children)
+
+    def test_interrupted_migration(self) -> None:
+        """A migration that fails halfway leaves no database behind, and is
+        done again on the next load."""
+
+        append(self.make_test_filename(), "testing1")
+        c1 = GitGud.for_working_dir(self.local_repo_path, global_config=global_config).commit(
+            "My first commit"
+        )
+
+        db_filename = GitGud.state_filename(self.local_repo_path, global_config) + ".sqlite"
+        with mock.patch.object(
+            SqliteStateStore, "_write_commit", side_effect=RuntimeError("Interrupted")
+        ):
+            with self.assertRaises(RuntimeError):
+                GitGud.for_working_dir(self.local_repo_path, global_config=sqlite_global_config)
+        self.assertFileDoesNotExist(db_filename)
+
+        self.assertEqual(c1.id, self.gg.head().id)
+        self.assertEqual(1, len(self.gg.get_snapshots(c1.id)))
+
+    def test_round_trip(self) -> None:
+        """Dropped commits and pending operations are stored in SQLite."""
+
+        append(self.make_test_filename(), "testing1")
+        c1 = self.gg.commit("My first commit")
+        append(self.make_test_filename(), "testing2")
+        c2 = self.gg.commit("My second commit")
+
+        self.gg.drop_commit(c2.id)
+        gg = self.gg
+        self.assertIsInstance(gg._state_store, SqliteStateStore)
+        self.assertNotIn(c2.id, gg.state.commits)
+        self.assertEqual([], gg.get_commit(c1.id).children)
+
+        operation = PendingOperation(
+            type=OperationType.EVOLVE,
+            evolve_op=EvolveOperation(base_commit_id="master", target_commit_id=c1.id),
+        )
+        gg.enqueue_op(operation)
+        self.assertEqual([operation], self.gg.state.pending_operations)
+
+        gg.state.pending_operations = []
+        gg.save_state()
+        self.assertEqual([], self.gg.state.pending_operations)
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)